@@ -1,57 +1,82 @@
+import os
 import sys
+import tempfile
 import polars as pl
+from table_io import read_table, scan_table, sink_table
 
 #combine files based on t
 # Alter timestamps to make sure days are reflected correctly
 #Select GEOIDs based on k
 
+def parse_list(value):
+    """
+    Split a comma separated argument into a list of ints
+    """
+    return [int(x) for x in str(value).split(',')]
+
+def scan_days(depr_fn) -> pl.LazyFrame:
+    """
+    Lazily scan simulated trajectories for consecutive days into one frame, in day order
+
+    Note:
+    Time is incremented by (24*day number) hours.
+    This is important because applying privacy involves sorting by time
+    """
+    return pl.concat([scan_day(fn, i) for i, fn in enumerate(depr_fn)])
+
+def scan_day(fn, day) -> pl.LazyFrame:
+    """
+    Lazily scan simulated trajectories for one day, with time offset by 24*day hours
+    """
+    depr = scan_table(fn,
+                      dtypes={'uid': pl.Int32,
+                              'time': pl.Float32,
+                              'geoid': pl.Utf8})
+    return depr.select([
+        'uid',
+        (pl.col('time') + (day*24)).cast(pl.Float32).alias('time'),
+        'geoid',
+        pl.lit(day, dtype=pl.Int32).alias('day')
+    ])
+
+def cluster_days(days: pl.LazyFrame, geoid_lu: pl.DataFrame, space_k) -> pl.LazyFrame:
+    """
+    Trajectories (uid, time, geoid) with geoids remapped to the k_cluster of space_k, 
+    null for geoids missing from the lookup
+    """
+    lu = geoid_lu.filter(pl.col('k') == space_k).select(['GEOID', 'k_cluster']).lazy()
+    return (days
+            .join(lu, left_on='geoid', right_on='GEOID', how='left')
+            .select(['uid', 'time', pl.col('k_cluster').alias('geoid')]))
 
 def main():
 
-    space_k = int(sys.argv[1])
-    time_t = int(sys.argv[2])
-
-    geoid_lu = pl.read_csv(sys.argv[3],
-                           dtypes={'GEOID': pl.Utf8,
-                                   "k": pl.Int32,
-                                   "cluster": pl.Utf8,
-                                   "k_cluster": pl.Utf8})
-    
-    geoid_lu_k = geoid_lu.filter(geoid_lu['k'] == space_k)
-    
-    depr_fn = sys.argv[(3+1):(3+1+time_t)]
-
-    depr_concat = pl.DataFrame({'uid': [],
-                         'time': [],
-                         'geoid': []},
-                         schema={'uid': pl.Utf8,
-                                 'time': pl.Float32,
-                                 'geoid': pl.Utf8})
-
-    for i, fn in enumerate(depr_fn):
-        depr = pl.read_csv(fn,
-                           dtypes={'uid': pl.Utf8,
-                                   'time': pl.Float32,
-                                   'geoid': pl.Utf8})
-        
-        depr = depr.with_columns(
-            # Increment time by (24*day number) hours
-            # This is important because applying privacy involves sorting by time
-            (depr['time'] + (i*24)).cast(pl.Float32).alias('time')
-        )
-
-        depr = depr.join(geoid_lu_k.select(["GEOID", "k_cluster"]), left_on='geoid', right_on="GEOID",  
-                         how='left')
-        
-        depr = depr.with_columns(
-            depr['k_cluster'].alias('geoid')
-        )
-
-        depr = depr.drop('k_cluster')
-
-        depr_concat = pl.concat([depr_concat, depr])
-
-    depr_concat.write_csv(sys.argv[-1])    
+    space_ks = parse_list(sys.argv[1])
+    time_ts = parse_list(sys.argv[2])
+
+    geoid_lu = read_table(sys.argv[3],
+                          dtypes={'GEOID': pl.Utf8,
+                                  "k": pl.Int32,
+                                  "cluster": pl.Utf8,
+                                  "k_cluster": pl.Utf8})
+
+    depr_fn = sys.argv[(3+1):(3+1+max(time_ts))]
+
+    # Output filename with {space} and {t} placeholders
+    outfn = sys.argv[-1]
+
+    # Each day is remapped to clusters on its own, then the first t days are 
+    # streamed into each partition, so memory does not grow with the number of days
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(outfn))) as tmpdir:
+        for space_k in space_ks:
+            day_fns = []
+            for i, fn in enumerate(depr_fn):
+                day_fns.append(os.path.join(tmpdir, f"space_{space_k}_day_{i}.parquet"))
+                sink_table(cluster_days(scan_day(fn, i), geoid_lu, space_k), day_fns[-1])
+
+            for t in time_ts:
+                sink_table(pl.concat([scan_table(day_fn) for day_fn in day_fns[:t]]), 
+                           outfn.format(space=space_k, t=t))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,14 +1,166 @@
+import hashlib
+import json
 import click
+import numpy as np
 import polars as pl
-from privacy import bounded_sum_gdp, freq_cms
+import instrument
+from privacy import bound_contributions, bounded_sum, gdp_noise, cms_counts, k_anonymous_sums, with_trials
+from od import read_od_trips
+from error_model import od_summary, predict_grid, frontier, calibrate
+from calc_privacy_error import PARAMS, domain_metrics
+from result_cache import DEFAULT_CACHE_GB, open_cache, file_fingerprint, source_fingerprint
+from table_io import write_table
+
+def parse_grid(value):
+    """
+    Split a comma separated option into a list of parameter values
+    """
+    return str(value).split(',')
+
+def privacy_grid(construction, epsilon, sensitivity, k, m):
+    """
+    (sensitivity, epsilon, k, m) of every configuration in the grid, in the order they are run
+
+    Note: KANON configurations are its thresholds, given as k
+    """
+    if construction == "GDP":
+        return [(s, e, k, m) 
+                for s in parse_grid(sensitivity) 
+                for e in parse_grid(epsilon)]
+    if construction == "KANON":
+        return [(sensitivity, epsilon, k_i, m) 
+                for k_i in parse_grid(k)]
+    return [(s, e, k_i, m_i) 
+            for s in parse_grid(sensitivity) 
+            for k_i in parse_grid(k) 
+            for m_i in parse_grid(m) 
+            for e in parse_grid(epsilon)]
+
+def config_rng(seed, fingerprint, *config):
+    """
+    RNG for one configuration (or bounded sample) of a grid on an input
+
+    Note:
+    Streams are derived from seed, the input fingerprint and the configuration, 
+    so a configuration gives the same result whichever grid it is run in and can be 
+    cached, while different inputs (dates, divisions, space-time scales) draw 
+    independent noise
+    """
+    if seed is None:
+        return np.random.default_rng()
+    digest = hashlib.sha256(json.dumps([fingerprint] + [str(c) for c in config]).encode()).digest()
+    return np.random.default_rng([seed, int.from_bytes(digest[:8], 'little')])
+
+def label_result(res, construction, s, e, k_i, m_i):
+    """
+    Add the construction and parameters of a configuration to its result
+    """
+    return res.with_columns(
+        pl.lit(construction).alias('construction'),
+        pl.lit(e).alias('epsilon'),
+        pl.lit(s).alias('sensitivity'),
+        pl.lit(m_i).alias('m'), 
+        pl.lit(k_i).alias('k')
+    )
+
+def bounded_sample(construction, depr, domain, sensitivity, rng):
+    """
+    Bounded sums by OD pair (GDP) or bounded OD trips with their od_id (CMS)
+    """
+    if construction == "GDP":
+        return bounded_sum(depr, ['geoid_o', 'geoid_d'], sensitivity, rng)
+    data = bound_contributions(depr, sensitivity, rng)
+    return data.join(domain, on=['geoid_o', 'geoid_d'], how='left')
+
+def run_configs(construction, configs, depr, domain, seed, fingerprint, cache, trials, discrete, shards, workers) -> dict:
+    """
+    Private analytics of each GDP or CMS configuration (sensitivity, epsilon, k, m), 
+    labelled with its parameters, by configuration
+
+    Note:
+    Bounded samples are drawn once per sensitivity and reused for every 
+    (epsilon, k, m) of the configurations given. With a cache, results are 
+    looked up and stored by the input fingerprint, configuration and the source 
+    of the modules computing them
+    """
+    results = {}
+    for s in dict.fromkeys(config[0] for config in configs):
+        data = None
+
+        for _, e, k_i, m_i in [config for config in configs if config[0] == s]:
+            params = (s, e) if construction == "GDP" else (s, e, k_i, m_i)
+
+            res = None
+            if cache is not None:
+                key = cache.key(
+                    input=fingerprint, 
+                    source=source_fingerprint('apply_privacy', 'privacy', 'cms', 'od'), 
+                    construction=construction, 
+                    params=params, 
+                    seed=seed, 
+                    trials=trials, 
+                    discrete=discrete if construction == "GDP" else None, 
+                    shards=shards if construction == "CMS" else None
+                )
+                res = cache.get(key)
+
+            if res is None:
+                if data is None:
+                    data = bounded_sample(construction, depr, domain, int(s), config_rng(seed, fingerprint, s))
+
+                rng = config_rng(seed, fingerprint, construction, *params)
+                if construction == "GDP":
+                    res = gdp_noise(data, int(s), float(e), rng, discrete, n_trials=trials)
+                else:
+                    res = cms_counts(domain, 
+                                     data, 
+                                     k=int(k_i), 
+                                     m=int(m_i), 
+                                     epsilon=float(e), 
+                                     rng=rng, 
+                                     n_shards=shards, 
+                                     n_workers=workers, 
+                                     n_trials=trials)
+
+                if cache is not None:
+                    cache.put(key, res)
+
+            results[(s, e, k_i, m_i)] = label_result(res, construction, s, e, k_i, m_i)
+
+    return results
+
+def simulated_metric(result, base_analytics, domain, metric):
+    """
+    Mean over trials of an error metric of a labelled result against base analytics, 
+    over the OD pairs of domain (see calc_privacy_error)
+    """
+    private = result.lazy().select(
+        ['geoid_o', 'geoid_d', pl.col('count').cast(pl.Float64)] 
+        + PARAMS 
+        + [pl.col('trial').cast(pl.Int32)])
+    return domain_metrics(private, base_analytics, domain)[metric].mean()
 
 @click.command()
 @click.option('--infn')
 @click.option('--construction')
-@click.option('--epsilon')
-@click.option('--sensitivity')
-@click.option('--k')
-@click.option('--m')
+@click.option('--epsilon', help='Comma separated values sweep a grid')
+@click.option('--sensitivity', help='Comma separated values sweep a grid')
+@click.option('--k', help='Comma separated values sweep a grid (thresholds for KANON)')
+@click.option('--m', help='Comma separated values sweep a grid')
+@click.option('--seed', type=int, default=None)
+@click.option('--discrete', is_flag=True, help='Use discrete Laplace noise for GDP')
+@click.option('--shards', type=int, default=1, help='Number of CMS sketches aggregated separately then merged')
+@click.option('--workers', type=int, default=1, help='Number of processes aggregating CMS shards')
+@click.option('--trials', type=int, default=1, help='Number of independent noise draws of each configuration (of one bounded sample)')
+@click.option('--acceptable', type=float, default=None, help='Only run configurations predicted to be near this error')
+@click.option('--metric', default='weighted_mape', help='Metric compared to --acceptable')
+@click.option('--band', type=float, default=1.0, help='Run configurations predicted within a factor of (1 + band) of --acceptable')
+@click.option('--max-runs', type=int, default=8, help='Maximum number of configurations run with --acceptable')
+@click.option('--calibration-runs', type=int, default=3, help='Configurations simulated to calibrate error predictions with --acceptable')
+@click.option('--predictions', help='Write the predicted error of every configuration')
+@click.option('--suppression', help='Write the suppression rates of every KANON threshold')
+@click.option('--cache-dir', envvar='RESULT_CACHE_DIR', help='Reuse results of identical inputs and configurations (requires --seed)')
+@click.option('--cache-gb', type=float, envvar='RESULT_CACHE_GB', default=DEFAULT_CACHE_GB, help='Maximum size of the result cache')
 @click.option('--outfn')
 def aggregate_with_privacy(
     infn,
@@ -17,54 +169,114 @@ def aggregate_with_privacy(
     sensitivity,
     k,
     m,
+    seed,
+    discrete,
+    shards,
+    workers,
+    trials,
+    acceptable,
+    metric,
+    band,
+    max_runs,
+    calibration_runs,
+    predictions,
+    suppression,
+    cache_dir,
+    cache_gb,
     outfn):
+    """
+    Aggregate trajectories with privacy for every combination of the 
+    epsilon, sensitivity, k and m values given
 
-    depr = pl.read_csv(
-        infn,
-        columns=['uid', 'time', 'geoid'],
-        dtypes={'geoid': pl.Utf8}
-    )
+    Note: 
+    Trajectories are loaded and converted to OD pairs once for the whole grid. 
+    Bounded samples are drawn once per sensitivity and reused for every 
+    (epsilon, k, m), so each configuration is correctly distributed although 
+    configurations with the same sensitivity are not independent. 
+    Trials are repeated noise draws (GDP) or privatisations (CMS) of the 
+    same bounded sample, numbered in the trial column, so their spread (and the 
+    intervals of calc_privacy_error) is the noise only, not the bounding variance. 
+    With --acceptable, the error of every configuration is predicted with 
+    error_model and only those near the acceptable error frontier are run. 
+    The --calibration-runs configurations predicted closest to it are simulated 
+    first, predictions are scaled by their simulated / predicted error and the band 
+    is widened by how far they still differ (see calibrate). Calibration runs are 
+    kept in the output. 
+    With a seed and --cache-dir, results are cached by the input fingerprint, 
+    configuration and source of the modules computing them, so they are shared 
+    between grids, rules and runs but never outlive a code change. 
+    KANON releases OD sums of at least each threshold k, computing every 
+    threshold from one sorted group by (see k_anonymous_sums)
+    """
 
-    depr = depr.sort(["uid", "time"]) \
-       .group_by("uid") \
-       .map_groups(lambda group: group.with_columns(group["geoid"].shift(-1).alias("geoid_d"))) \
-       .rename({'geoid': 'geoid_o'}) \
-       .filter(pl.col('geoid_d').is_not_null())
+    with instrument.stage('load_od'):
+        depr = read_od_trips(infn)
     
-    domain = depr.select([pl.col('geoid_o'), pl.col('geoid_d')]).unique()
+    domain = depr.select([pl.col('geoid_o'), pl.col('geoid_d')]).unique(maintain_order=True)
     domain = domain.with_columns(pl.Series("od_id", range(domain.height)))
 
     depr = depr.with_columns(pl.lit(1).alias('count'))
 
-    if construction == "GDP":
-        res = bounded_sum_gdp(
-            depr, 
-            ['geoid_o', 'geoid_d'], 
-            sensitivity=int(sensitivity), 
-            epsilon=float(epsilon)
-        )
-    elif construction == "CMS":
-         k = int(k)
-         m = int(m)
-         res = freq_cms(domain, 
-                   depr, 
-                   k=k,
-                   m=m,
-                   sensitivity=int(sensitivity),
-                   epsilon=float(epsilon))
+    if construction not in ["GDP", "CMS", "KANON"]:
+        raise ValueError("Unknown construction")
+
+    configs = privacy_grid(construction, epsilon, sensitivity, k, m)
+
+    if acceptable is not None and construction == "KANON":
+        raise ValueError("Error predictions are not available for KANON")
 
+    cache = open_cache(cache_dir, cache_gb) if seed is not None else None
+    if seed is None:
+        fingerprint = None
     else:
-        raise ValueError("Unknown construction")
-    
-    res = res.with_columns(
-            pl.lit(construction).alias('construction'),
-            pl.lit(epsilon).alias('epsilon'),
-            pl.lit(sensitivity).alias('sensitivity'),
-            pl.lit(m).alias('m'), 
-            pl.lit(k).alias('k')
-    )
+        fingerprint = cache.fingerprint(infn) if cache else file_fingerprint(infn)
+
+    results = {}
+    calibration = {}
+    if acceptable is not None:
+        with instrument.stage('predict_error'):
+            counts, trips_per_uid = od_summary(depr)
+            predicted = predict_grid(counts, trips_per_uid, construction, configs)
+
+        with instrument.stage('calibrate_error'):
+            closest = frontier(predicted, metric, acceptable, float('inf'), calibration_runs)
+            closest = set(closest.select(['sensitivity', 'epsilon', 'k', 'm']).iter_rows())
+            results = run_configs(construction, [config for config in configs if config in closest], 
+                                  depr, domain, seed, fingerprint, cache, trials, discrete, shards, workers)
+
+            base_analytics = depr.group_by(['geoid_o', 'geoid_d']).agg(pl.count().alias('count'))
+            simulated = {config: simulated_metric(res, base_analytics, domain, metric) 
+                         for config, res in results.items()}
+            predicted, spread = calibrate(predicted, simulated, metric)
+
+        if predictions:
+            write_table(predicted, predictions)
+
+        calibrated_band = (1 + band) * np.exp(spread) - 1
+        calibration = {'calibration_runs': len(simulated), 'calibrated_band': calibrated_band}
+        print(f"Calibrated {metric} predictions on {len(simulated)} configurations, band widened to {calibrated_band:.2f}")
+
+        near = frontier(predicted, f'{metric}_calibrated', acceptable, calibrated_band, max_runs)
+        near = set(near.select(['sensitivity', 'epsilon', 'k', 'm']).iter_rows())
+        configs = [config for config in configs if config in near or config in results]
+
+    if construction == "KANON":
+        released, suppressed = k_anonymous_sums(depr, ['geoid_o', 'geoid_d'], [int(config[2]) for config in configs])
+        if suppression:
+            write_table(suppressed, suppression)
+
+        results = {config: label_result(with_trials(res, 1), construction, *config) 
+                   for config, res in zip(configs, released)}
+    else:
+        results.update(run_configs(construction, [config for config in configs if config not in results], 
+                                   depr, domain, seed, fingerprint, cache, trials, discrete, shards, workers))
+
+    instrument.count('configurations', len(configs))
+
+    with instrument.stage('write_table'):
+        write_table(pl.concat([results[config] for config in configs]), outfn)
 
-    res.write_csv(outfn)
+    instrument.write_profile(outfn, construction=construction, trials=trials, seed=seed, **calibration)
 
 if __name__ == '__main__':
     aggregate_with_privacy()
\ No newline at end of file
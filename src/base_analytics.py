@@ -1,23 +1,19 @@
 import sys
-import polars as pl
+import instrument
+from od import scan_trip_batches, od_counts_from_batches
+from table_io import write_table
 
 def main():
 
-    depr = pl.read_csv(
-        sys.argv[1],
-        columns=['uid', 'time', 'geoid'],
-        dtypes={'geoid': pl.Utf8}
-    )
+    # OD pairs are counted one batch of trips at a time, 
+    # with the same OD stage as apply_privacy (see od_trip_batches)
+    with instrument.stage('od_counts'):
+        od = od_counts_from_batches(scan_trip_batches(sys.argv[1]))
 
-    depr = depr.sort(["uid", "time"]) \
-       .groupby("uid") \
-       .apply(lambda group: group.with_columns(group["geoid"].shift(-1).alias("geoid_d"))) \
-       .rename({'geoid': 'geoid_o'}) \
-       .filter(pl.col('geoid_d').is_not_null())
+    with instrument.stage('write_table'):
+        write_table(od, sys.argv[-1])
 
-    od = depr.groupby(['geoid_o', 'geoid_d']).count()
-
-    od.write_csv(sys.argv[-1])
+    instrument.write_profile(sys.argv[-1])
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
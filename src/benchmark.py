@@ -0,0 +1,215 @@
+import json
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import click
+import polars as pl
+import instrument
+from synthetic import N_COUNTIES, synthetic_counties, synthetic_pij, synthetic_trajectories
+from depr import build_pij_weights, build_alias_tables, sample_population, population_depr, population_depr_batched
+from od import od_trip_batches, od_counts_from_batches
+from privacy import bounded_sum_gdp, freq_cms
+
+# Synthetic input sizes: division is about the size of the focus division,
+# national is every US county at the depr.py sampling rate
+SCALES = {
+    'small': {'n_counties': 100, 'pop_sample_rate': 0.0005},
+    'division': {'n_counties': 400, 'pop_sample_rate': 0.005},
+    'national': {'n_counties': N_COUNTIES, 'pop_sample_rate': 0.005}
+}
+
+# DEPR parameters (rho, gamma, beta, tau, duration) as in depr.py
+DEPR_PARAMS = (0.6, 0.21, 0.8, 17, 24)
+
+# Individuals simulated by the (slow) scalar DEPR scenario
+SCALAR_DEPR_UIDS = 1_000
+
+SENSITIVITY = 5
+EPSILON = 1
+
+# Increases smaller than these are treated as noise when comparing to a baseline
+MIN_CHANGE = {'seconds': 0.05, 'peak_rss_mb': 16}
+
+def scale_inputs(scale, seed):
+    """
+    Synthetic counties, sampled population and the number of simulated individuals at a scale
+    """
+    counties = synthetic_counties(scale['n_counties'], seed=seed)
+    pop_sample = sample_population(counties.select(['GEOID', 'POPESTIMATE2019']), scale['pop_sample_rate'])
+    return counties, pop_sample, int(pop_sample['pop_sample'].sum())
+
+def od_trips(counties, n_uids, seed):
+    """
+    OD trips (uid, geoid_o, geoid_d, count) of synthetic trajectories, as in apply_privacy
+    """
+    trajectories = synthetic_trajectories(counties, n_uids, seed=seed)
+    return (pl.concat(list(od_trip_batches(trajectories.iter_slices(2**22))))
+            .with_columns(pl.lit(1).alias('count')))
+
+def setup_build_pij_weights(scale, seed):
+    counties, _, _ = scale_inputs(scale, seed)
+    return (synthetic_pij(counties),)
+
+def run_build_pij_weights(pij):
+    return build_alias_tables(build_pij_weights(pij))
+
+def setup_population_depr(scale, seed):
+    counties, pop_sample, n_uids = scale_inputs(scale, seed)
+    pop_sample = pop_sample.with_columns(
+        (pl.col('pop_sample') * SCALAR_DEPR_UIDS / n_uids).ceil().cast(pl.Int32).alias('pop_sample')
+    )
+    return pop_sample, build_alias_tables(build_pij_weights(synthetic_pij(counties)))
+
+def run_population_depr(pop_sample, pij_weights):
+    return population_depr(pop_sample, pij_weights, *DEPR_PARAMS)
+
+def setup_population_depr_batched(scale, seed):
+    counties, pop_sample, _ = scale_inputs(scale, seed)
+    return pop_sample, build_alias_tables(build_pij_weights(synthetic_pij(counties))), seed
+
+def run_population_depr_batched(pop_sample, pij_weights, seed):
+    return population_depr_batched(pop_sample, pij_weights, *DEPR_PARAMS, seed=seed)
+
+def run_population_depr_history(pop_sample, pij_weights, seed):
+    # Preferential return and visit counts are only exercised with update_history
+    return population_depr_batched(pop_sample, pij_weights, *DEPR_PARAMS, seed=seed, update_history=True)
+
+def setup_od_counts(scale, seed):
+    counties, _, n_uids = scale_inputs(scale, seed)
+    return (synthetic_trajectories(counties, n_uids, seed=seed),)
+
+def run_od_counts(trajectories):
+    # Batches of trips as read by base_analytics
+    return od_counts_from_batches(trajectories.iter_slices(2**22))
+
+def setup_bounded_sum_gdp(scale, seed):
+    counties, _, n_uids = scale_inputs(scale, seed)
+    return od_trips(counties, n_uids, seed), seed
+
+def run_bounded_sum_gdp(data, seed):
+    return bounded_sum_gdp(data, ['geoid_o', 'geoid_d'], SENSITIVITY, EPSILON, seed=seed)
+
+def setup_freq_cms(scale, seed):
+    counties, _, n_uids = scale_inputs(scale, seed)
+    data = od_trips(counties, n_uids, seed)
+    domain = data.select(['geoid_o', 'geoid_d']).unique()
+    domain = domain.with_columns(pl.Series('od_id', range(domain.height)))
+    # Hash parameters as fractions of the sample and domain sizes, as in the Snakefile
+    k = max(1, int(0.001 * n_uids))
+    m = max(2, int(0.01 * domain.height))
+    return domain, data, m, k, seed
+
+def run_freq_cms(domain, data, m, k, seed):
+    return freq_cms(domain, data, m, k, SENSITIVITY, EPSILON, seed=seed)
+
+# Scenario name: (setup, run), only run is timed
+SCENARIOS = {
+    'build_pij_weights': (setup_build_pij_weights, run_build_pij_weights),
+    'population_depr': (setup_population_depr, run_population_depr),
+    'population_depr_batched': (setup_population_depr_batched, run_population_depr_batched),
+    'population_depr_history': (setup_population_depr_batched, run_population_depr_history),
+    'od_counts': (setup_od_counts, run_od_counts),
+    'bounded_sum_gdp': (setup_bounded_sum_gdp, run_bounded_sum_gdp),
+    'freq_cms': (setup_freq_cms, run_freq_cms)
+}
+
+def run_scenario(name, scale, seed, repeat):
+    """
+    Set up and run a scenario repeat times, returning the fastest run time,
+    the peak RSS before and after running and the stage profile of the last run
+
+    Note: run in a fresh process so the peak RSS is that of the scenario alone
+    """
+    setup, run = SCENARIOS[name]
+    args = setup(SCALES[scale], seed)
+    setup_rss_mb = instrument.peak_rss_mb()
+
+    seconds = []
+    for _ in range(repeat):
+        with instrument.collect() as profile:
+            start = time.perf_counter()
+            run(*args)
+            seconds.append(time.perf_counter() - start)
+
+    return {
+        'seconds': min(seconds),
+        'setup_rss_mb': setup_rss_mb,
+        'peak_rss_mb': instrument.peak_rss_mb(),
+        'stages': profile['stages'],
+        'counters': profile['counters']
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Scenarios whose run time or peak RSS is more than a fraction tolerance
+    (and more than MIN_CHANGE) above the baseline
+    """
+    regressions = []
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        for measure in ['seconds', 'peak_rss_mb']:
+            ratio = result[measure] / base[measure]
+            print(f"{name:<24} {measure:<12} {base[measure]:>10.3f} -> {result[measure]:>10.3f} ({ratio:.2f}x)")
+            if ratio > 1 + tolerance and result[measure] - base[measure] > MIN_CHANGE[measure]:
+                regressions.append((name, measure, ratio))
+    return regressions
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='small')
+@click.option('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenario names')
+@click.option('--seed', type=int, default=1)
+@click.option('--repeat', type=int, default=3, help='Number of timed runs, the fastest is kept')
+@click.option('--baseline', type=click.Path(), help='Results of a previous run to compare against')
+@click.option('--tolerance', type=float, default=0.25, help='Allowed fractional increase over the baseline')
+@click.option('--outfn', type=click.Path(), help='Write results as JSON')
+def benchmark(scale, scenarios, seed, repeat, baseline, tolerance, outfn):
+    """
+    Time and track the memory of hot paths on synthetic inputs,
+    optionally failing on regressions against a baseline
+
+    Note:
+    Each scenario runs in a new (spawned) process. Baselines are only comparable
+    between runs on the same machine at the same scale and seed
+    """
+    names = scenarios.split(',')
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise click.BadParameter(f"Unknown scenarios: {sorted(unknown)}")
+
+    results = {
+        'scale': scale,
+        'seed': seed,
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'polars': pl.__version__,
+        'machine': platform.machine(),
+        'scenarios': {}
+    }
+
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            result = pool.submit(run_scenario, name, scale, seed, repeat).result()
+        results['scenarios'][name] = result
+        print(f"{name:<24} {result['seconds']:>10.3f} s {result['peak_rss_mb']:>10.1f} MB")
+
+    if outfn:
+        with open(outfn, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            baseline = json.load(f)
+        if baseline['scale'] != scale:
+            raise click.BadParameter(f"Baseline is at scale {baseline['scale']}, not {scale}")
+
+        regressions = compare(results, baseline, tolerance)
+        if regressions:
+            for name, measure, ratio in regressions:
+                print(f"Regression: {name} {measure} {ratio:.2f}x baseline")
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,19 @@
+import sys
+import polars as pl
+from depr import build_pij_weights, build_alias_tables, save_pij_weights
+from table_io import read_table
+
+def main():
+
+    pij = read_table(
+        sys.argv[1],
+        columns=['geoid_o', 'geoid_d', 'value'],
+        dtypes={'geoid_o': pl.Utf8, 'geoid_d': pl.Utf8}
+    )
+
+    pij_weights = build_alias_tables(build_pij_weights(pij))
+
+    save_pij_weights(pij_weights, sys.argv[-1])
+
+if __name__ == '__main__':
+    main()
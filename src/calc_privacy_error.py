@@ -1,35 +1,61 @@
-import sys
+import click
+import numpy as np
 import polars as pl
+import instrument
+from clean_mob import division_geoids
+from table_io import read_table, scan_table, write_table, sink_table
 
-def main():
+PARAMS = ['construction', 'k', 'm', 'epsilon', 'sensitivity']
 
-    base_analytics = pl.read_csv(sys.argv[1])
+METRICS = ['rmse', 'weighted_rmse', 'mape', 'weighted_mape']
 
-    # compute a weight column that is the proportion of the total count
-    base_analytics = base_analytics.with_columns(
-        (pl.col('count') / pl.sum("count")).alias('weight')
-    )
-    
-    infns = sys.argv[2:-2]
+# Normal quantile of two sided 95% confidence intervals
+CI_Z = 1.96
+
+def scan_private(infns) -> pl.LazyFrame:
+    """
+    Lazily scan private analytics from every file (or glob of files) at once
 
+    Note:
+    Files without a trial column are a single trial (trial 0)
+    """
     dtypes = {
+        'geoid_o': pl.Utf8,
+        'geoid_d': pl.Utf8,
+        'construction': pl.Utf8,
         'epsilon': pl.Utf8,
         'sensitivity': pl.Utf8,
         'm': pl.Utf8,
         'k': pl.Utf8
     }
+    private = []
+    for infn in infns:
+        lf = scan_table(infn, dtypes=dtypes)
+        if 'trial' not in lf.columns:
+            lf = lf.with_columns(pl.lit(0).alias('trial'))
+        private.append(lf.select(
+            ['geoid_o', 'geoid_d', pl.col('count').cast(pl.Float64)] 
+            + list(dtypes)[2:] 
+            + [pl.col('trial').cast(pl.Int32)]))
+    return pl.concat(private)
 
-    # concat all files
-    df = pl.read_csv(infns[0],
-                    dtypes=dtypes)
-    for infn in infns[1:]:
-        df = pl.concat([df, pl.read_csv(infn, dtypes=dtypes)])
+def error_table(private: pl.LazyFrame, base_analytics: pl.DataFrame) -> pl.LazyFrame:
+    """
+    Join private counts to base analytics and compute the error of each OD pair
+    """
+    # compute a weight column that is the proportion of the total count
+    base_analytics = base_analytics.select([
+        'geoid_o',
+        'geoid_d',
+        'count',
+        (pl.col('count') / pl.sum("count")).alias('weight')
+    ])
 
-    df = df.rename({'count': 'count_private'})
-    df = df.join(base_analytics, on=['geoid_o', 'geoid_d'])
+    df = private.rename({'count': 'count_private'})
+    df = df.join(base_analytics.lazy(), on=['geoid_o', 'geoid_d'])
 
     # This could be made into a single function for annotations in fig 3
-    df = df.with_columns(
+    return df.with_columns(
         ((pl.col('count_private') - pl.col('count')) ** 2).alias('squared_error'),
         ((pl.col('count_private') - pl.col('count')) ** 2 * pl.col('weight'))
         .alias('weighted_squared_error'),
@@ -38,27 +64,154 @@ def main():
         ((pl.col('count_private') - pl.col('count')).abs() / (pl.col('count') + 1e-8) * 100 * pl.col('weight'))
         .alias('weighted_absolute_percentage_error')
         )
-    
-    metrics_df = (
-        df.groupby(['construction', 'k', 'm', 'epsilon', 'sensitivity'])
-        .agg([
-            pl.mean('squared_error').alias('mean_squared_error'),
-            pl.sum('weighted_squared_error').alias('sum_weighted_squared_error'),
-            pl.mean('absolute_percentage_error').alias('mean_absolute_percentage_error'),
-            pl.sum('weighted_absolute_percentage_error').alias('sum_weighted_absolute_percentage_error'),
-            pl.sum('weight').alias('sum_weight')
-        ])
-        .with_columns([
-            pl.col('mean_squared_error').sqrt().alias('rmse'),
-            (pl.col('sum_weighted_squared_error').sqrt() / pl.col('sum_weight')).alias('weighted_rmse'),
-            pl.col('mean_absolute_percentage_error').alias('mape'),
-            (pl.col('sum_weighted_absolute_percentage_error') / pl.col('sum_weight')).alias('weighted_mape')
-        ])
-        .drop(['mean_squared_error', 'mean_absolute_percentage_error', 'sum_weighted_squared_error', 'sum_weighted_absolute_percentage_error', 'sum_weight'])
-    )
-
-    df.write_csv(sys.argv[-2])
-    metrics_df.write_csv(sys.argv[-1])
+
+def od_domain(private: pl.LazyFrame, base_analytics: pl.DataFrame, geoids=None) -> pl.DataFrame:
+    """
+    Every OD pair in base or private analytics, 
+    and every pair of geoids (i.e. the counties of a division) if given
+    """
+    pairs = [pl.concat([
+        base_analytics.lazy().select(['geoid_o', 'geoid_d']),
+        private.select(['geoid_o', 'geoid_d'])
+    ]).unique().collect(streaming=True)]
+    if geoids is not None:
+        geoids = pl.DataFrame({'geoid': geoids}, schema={'geoid': pl.Utf8})
+        pairs.append(geoids.select(pl.col('geoid').alias('geoid_o'))
+                     .join(geoids.select(pl.col('geoid').alias('geoid_d')), how='cross'))
+    return pl.concat(pairs).unique()
+
+def domain_metrics(private: pl.LazyFrame, base_analytics: pl.DataFrame, domain: pl.DataFrame) -> pl.DataFrame:
+    """
+    rmse, weighted_rmse, mape and weighted_mape for each set of privacy parameters
+    and trial, over every OD pair in the domain
+
+    Note:
+    OD pairs missing from base analytics have a true count of zero and pairs not 
+    released by a construction (i.e. GDP groups not sampled) have a private count 
+    of zero, so all constructions are compared over the same cells. 
+    Percentage errors are undefined for empty cells, so mape is over cells with 
+    a nonzero true count and empty cells only enter weighted_mape with zero weight. 
+    n_empty and n_unreleased count the cells that are zero on either side.
+
+    Private counts are aggregated in one grouped pass over released cells. 
+    The error of an unreleased cell is its true count, so its terms are added 
+    analytically: e.g. the squared error of all cells is the sum over released cells 
+    of (error^2 - count^2) plus the sum of count^2 over every cell
+    """
+    n = domain.height
+
+    base = base_analytics.select([
+        'geoid_o', 
+        'geoid_d', 
+        pl.col('count').cast(pl.Float64).alias('true_count'), 
+        (pl.col('count') / pl.sum('count')).alias('weight')
+    ])
+    true_count = base['true_count'].to_numpy()
+    weight = base['weight'].to_numpy()
+    nonempty = true_count > 0
+
+    error = pl.col('count') - pl.col('true_count')
+    # Percentage error, less the 100% of an unreleased cell, over nonempty cells
+    percentage_excess = pl.when(pl.col('true_count') > 0) \
+        .then(error.abs() / pl.col('true_count') * 100 - 100) \
+        .otherwise(0)
+
+    sets = (private
+            .join(base.lazy(), on=['geoid_o', 'geoid_d'], how='left')
+            .with_columns(pl.col(['true_count', 'weight']).fill_null(0))
+            .group_by(PARAMS + ['trial'], maintain_order=True)
+            .agg([
+                (error ** 2 - pl.col('true_count') ** 2).sum().alias('squared_excess'),
+                (pl.col('weight') * (error ** 2 - pl.col('true_count') ** 2)).sum().alias('weighted_squared_excess'),
+                percentage_excess.sum().alias('percentage_excess'),
+                (pl.col('weight') * percentage_excess).sum().alias('weighted_percentage_excess'),
+                pl.count().alias('n_released')
+            ])
+            .collect(streaming=True))
+
+    squared_error = sets['squared_excess'].to_numpy() + np.sum(true_count ** 2)
+    weighted_squared_error = sets['weighted_squared_excess'].to_numpy() + np.sum(weight * true_count ** 2)
+    percentage_error = sets['percentage_excess'].to_numpy() + 100 * np.count_nonzero(nonempty)
+    weighted_percentage_error = sets['weighted_percentage_excess'].to_numpy() + 100 * np.sum(weight[nonempty])
+
+    return sets.select(PARAMS + [pl.col('trial').cast(pl.Int32)]).with_columns([
+        pl.Series('rmse', np.sqrt(squared_error / n)),
+        pl.Series('weighted_rmse', np.sqrt(weighted_squared_error) / np.sum(weight)),
+        pl.Series('mape', percentage_error / np.count_nonzero(nonempty)),
+        pl.Series('weighted_mape', weighted_percentage_error / np.sum(weight)),
+        pl.lit(n, dtype=pl.Int64).alias('n_cells'),
+        pl.lit(n - np.count_nonzero(nonempty), dtype=pl.Int64).alias('n_empty'),
+        (n - sets['n_released']).cast(pl.Int64).alias('n_unreleased')
+    ])
+
+def summarise_trials(metrics: pl.DataFrame) -> pl.DataFrame:
+    """
+    Mean and 95% confidence interval of the mean of each metric over trials
+
+    Note:
+    Intervals are normal approximations, mean +/- CI_Z standard errors, 
+    and are null for a single trial. Trials of a configuration share one bounded 
+    sample (see apply_privacy), so intervals cover the privacy noise only, 
+    not the variance of bounding contributions
+    """
+    return (metrics
+            .group_by(PARAMS, maintain_order=True)
+            .agg(
+                [pl.col(metric).mean() for metric in METRICS]
+                + [(CI_Z * pl.col(metric).std() / pl.count().sqrt()).alias(f'{metric}_ci') for metric in METRICS]
+                + [pl.col(['n_cells', 'n_empty']).first(), 
+                   pl.col('n_unreleased').mean(), 
+                   pl.count().alias('n_trials')]
+            )
+            .with_columns(
+                [(pl.col(metric) - pl.col(f'{metric}_ci')).alias(f'{metric}_lower') for metric in METRICS]
+                + [(pl.col(metric) + pl.col(f'{metric}_ci')).alias(f'{metric}_upper') for metric in METRICS]
+            )
+            .select(PARAMS 
+                    + [col for metric in METRICS for col in [metric, f'{metric}_lower', f'{metric}_upper']]
+                    + ['n_cells', 'n_empty', 'n_unreleased', 'n_trials']))
+
+@click.command()
+@click.argument('base_fn')
+@click.argument('infns', nargs=-1)
+@click.option('--errors', 'errors_fn', help='Also write the error of every OD pair and parameter set')
+@click.option('--metrics', 'metrics_fn')
+@click.option('--pop', 'pop_fn', help='Population table, with --division-lu and --division')
+@click.option('--division-lu', 'division_lu_fn', help='Division lookup table, with --pop and --division')
+@click.option('--division', help='Include every pair of counties in this division in the OD domain')
+def main(base_fn, infns, errors_fn, metrics_fn, pop_fn, division_lu_fn, division):
+    """
+    Error metrics of private analytics in INFNS (files or globs) against base analytics
+
+    Note:
+    All inputs are scanned lazily together. Metrics are computed over the 
+    whole OD domain in one grouped pass, see domain_metrics, and summarised 
+    over trials. With --division, the domain includes every pair of the 
+    division's counties, so pairs without trips are counted as empty cells. The error table of OD pairs in both base 
+    and private analytics (first trial only) is only written when --errors is given, 
+    streamed to disk for parquet or ipc and collected for CSV (see sink_table)
+    """
+    base_analytics = read_table(base_fn, dtypes={'geoid_o': pl.Utf8, 'geoid_d': pl.Utf8})
+
+    private = scan_private(infns)
+
+    if errors_fn:
+        with instrument.stage('error_table'):
+            sink_table(error_table(private.filter(pl.col('trial') == 0), base_analytics), errors_fn)
+
+    with instrument.stage('od_domain'):
+        geoids = None
+        if division is not None:
+            pop = read_table(pop_fn, columns=['GEOID'], dtypes={'GEOID': pl.Utf8})
+            geoids = division_geoids(pop, read_table(division_lu_fn), division)
+        domain = od_domain(private, base_analytics, geoids)
+
+    with instrument.stage('domain_metrics'):
+        metrics = domain_metrics(private, base_analytics, domain)
+
+    write_table(summarise_trials(metrics), metrics_fn)
+
+    instrument.write_profile(metrics_fn)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,42 +1,78 @@
 import sys
 import polars as pl
+from table_io import read_table, scan_table, write_table
+
+def geoid_index(pop) -> pl.DataFrame:
+    """
+    Index of geoids with population data
+    """
+    return pop.select(pl.col('GEOID').unique(maintain_order=True))
+
+def sparse_od(mob: pl.LazyFrame, index: pl.DataFrame) -> pl.LazyFrame:
+    """
+    Nonzero flows between geoids in the index
+
+    Note:
+    Pairs absent from the sparse table have zero flow.
+    Semi joins against the geoid index filter both ends of each flow
+    without building the dense cross join of all counties
+    """
+    index = index.lazy()
+    return (mob
+            .filter(pl.col('pop_flows') > 0)
+            .join(index, left_on='geoid_o', right_on='GEOID', how='semi')
+            .join(index, left_on='geoid_d', right_on='GEOID', how='semi'))
+
+def division_geoids(pop, division_lu, division) -> pl.Series:
+    """
+    Geoids with population data in the states of one division
+    """
+    states = (division_lu
+              .filter(pl.col('SUBDIVISION').cast(pl.Utf8) == str(division))
+              .select(pl.col('STATE').cast(pl.Utf8).str.zfill(2)))
+    return (geoid_index(pop)
+            .filter(pl.col('GEOID').str.slice(0, 2).is_in(states['STATE']))
+            .sort('GEOID'))['GEOID']
+
+def densify(mob, geoids) -> pl.DataFrame:
+    """
+    Dense flows between every pair of geoids, with absent pairs filled with zero
+
+    Note:
+    Only use on a subset of geoids (i.e. one division),
+    the dense table grows with the square of the number of geoids
+    """
+    origins = pl.DataFrame({'geoid_o': geoids}, schema={'geoid_o': pl.Utf8})
+    destinations = origins.rename({'geoid_o': 'geoid_d'})
+
+    mob_full = origins.join(destinations, how='cross')
+
+    mob_full = mob_full.join(mob, on=["geoid_o", "geoid_d"], how="left")
+
+    return mob_full.with_columns(pl.col('pop_flows').fill_null(0))
 
 def main():
 
-    # Read observed data
-    mob = pl.read_csv(sys.argv[1], 
-                      columns=[
-                          "geoid_o", 
-                          "geoid_d", 
-                          "pop_flows"], 
-                      dtypes={
-                          'geoid_o': pl.Utf8, 
-                          'geoid_d': pl.Utf8
-                        })
-
-    pop = pl.read_csv(
-        sys.argv[2], 
+    # Scan observed data
+    mob = scan_table(sys.argv[1],
+                     dtypes={
+                         'geoid_o': pl.Utf8,
+                         'geoid_d': pl.Utf8
+                       }).select([
+                         "geoid_o",
+                         "geoid_d",
+                         pl.col("pop_flows").cast(pl.Int64)])
+
+    pop = read_table(
+        sys.argv[2],
         columns=["GEOID"],
         dtypes={'GEOID': pl.Utf8}
     )
 
-    mob = mob.with_columns(pl.col("pop_flows").cast(pl.Int64))
-    
     # Same - some counties are missing population data
-    mob = mob.filter(mob["geoid_o"].is_in(pop["GEOID"]) & mob["geoid_d"].is_in(pop["GEOID"]))
-
-    mob_full = pop.join(pop, how='cross')
-
-    mob_full = mob_full.rename({
-        'GEOID': 'geoid_o', 
-        'GEOID_right': 'geoid_d'
-        })
-    
-    mob_full = mob_full.join(mob, on=["geoid_o", "geoid_d"], how="left")
-
-    mob_full = mob_full.fill_null(0)
+    mob = sparse_od(mob, geoid_index(pop))
 
-    mob_full.write_csv(sys.argv[3])
+    write_table(mob.collect(streaming=True), sys.argv[3])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,5 +1,6 @@
 import sys
 import polars as pl
+from table_io import write_table
 
 def main():
 
@@ -18,7 +19,7 @@ def main():
 
     pop = pop.drop(['STATE', 'COUNTY'])
 
-    pop.write_csv(sys.argv[2])
+    write_table(pop, sys.argv[2])
 
 
 if __name__ == '__main__':
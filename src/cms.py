@@ -0,0 +1,199 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import instrument
+
+# Mersenne prime for universal hashing of integer items
+HASH_PRIME = 2**31 - 1
+
+class CountMeanSketch:
+    """
+    Apple's Count Mean Sketch (CMS) with NumPy arrays
+
+    Uses the same client perturbation and server estimator as
+    pure_ldp's CMSClient / CMSServer (is_hadamard=False),
+    but privatises, aggregates and estimates whole arrays of integer items at once.
+    Hash functions are universal hashes drawn from hash_seed rather than pure_ldp's 
+    xxhash, so estimates match pure_ldp in distribution, not report for report
+
+    epsilon: privacy budget
+    k: number of hash functions
+    m: size of hash domain
+    hash_seed: seed for the (public) hash functions shared by clients and server
+    """
+
+    def __init__(self, epsilon, k, m, hash_seed=0):
+        self.epsilon = epsilon
+        self.k = k
+        self.m = m
+        self.hash_seed = hash_seed
+
+        self.prob = 1 / (1 + math.pow(math.e, epsilon / 2))
+        self.c = (math.pow(math.e, epsilon / 2) + 1) / (math.pow(math.e, epsilon / 2) - 1)
+
+        hash_rng = np.random.default_rng(hash_seed)
+        self.hash_a = hash_rng.integers(1, HASH_PRIME, size=k, dtype=np.int64)
+        self.hash_b = hash_rng.integers(0, HASH_PRIME, size=k, dtype=np.int64)
+
+        self.sketch = np.zeros((k, m))
+        self.n = 0
+
+    def hash(self, j, items):
+        """
+        Hash items with hash functions j (broadcastable arrays)
+        """
+        return ((self.hash_a[j] * items + self.hash_b[j]) % HASH_PRIME) % self.m
+
+    def privatise(self, items, rng):
+        """
+        Client side: privatise each item as a perturbed {-1, 1} vector of length m
+        and the index of the hash function used
+
+        Note:
+        Returns an (n, m) matrix, use privatise_aggregate for large batches
+        """
+        items = np.asarray(items, dtype=np.int64)
+        j = rng.integers(0, self.k, size=len(items))
+        v = np.full((len(items), self.m), -1, dtype=np.int8)
+        v[np.arange(len(items)), self.hash(j, items)] = 1
+        v[rng.random(v.shape) < self.prob] *= -1
+        return v, j
+
+    def aggregate(self, v, j):
+        """
+        Server side: add privatised reports to the sketch matrix
+        """
+        np.add.at(self.sketch, j, self.k * ((self.c / 2) * v + 0.5))
+        self.n += len(j)
+
+    def privatise_aggregate(self, items, rng, counts=None, block_size=2**22):
+        """
+        Privatise and aggregate items without materialising the individual reports
+
+        counts: number of reports of each item (default one report per item)
+
+        Note:
+        For each sketch cell, the sum of n_j reports with hash function j is determined by
+        how many reports hash to the cell and how many bits are flipped. Splitting the reports
+        of each item over hash functions (a multinomial, drawn as successive binomials) and
+        drawing the flips as binomials over the hits and misses of each cell gives the same
+        distribution as aggregating individually privatised reports, in O(k * (items + m))
+        once items are counted. Passing counts lets repeated privatisations of the same
+        data (trials) skip counting items
+        """
+        with instrument.stage('cms_privatise_aggregate'):
+            if counts is None:
+                items, counts = np.unique(np.asarray(items, dtype=np.int64), return_counts=True)
+            items = np.asarray(items, dtype=np.int64)
+            remaining = np.asarray(counts, dtype=np.int64).copy()
+            n = int(remaining.sum())
+
+            rows_per_block = max(1, block_size // self.m)
+            for start in range(0, self.k, rows_per_block):
+                end = min(start + rows_per_block, self.k)
+
+                hits = np.empty((end - start, self.m), dtype=np.int64)
+                for j in range(start, end):
+                    n_item = rng.binomial(remaining, 1 / (self.k - j))
+                    remaining -= n_item
+                    hits[j - start] = np.bincount(self.hash(j, items), weights=n_item, minlength=self.m)
+                n_j = hits.sum(axis=1)
+                misses = n_j[:, None] - hits
+
+                v_sum = (hits - 2 * rng.binomial(hits, self.prob)) \
+                    - (misses - 2 * rng.binomial(misses, self.prob))
+
+                self.sketch[start:end] += self.k * ((self.c / 2) * v_sum + 0.5 * n_j[:, None])
+
+        self.n += n
+        instrument.count('cms_reports', n)
+
+    def estimate(self, items, block_size=2**22):
+        """
+        Estimate the frequency of each item
+        """
+        with instrument.stage('cms_estimate'):
+            items = np.asarray(items, dtype=np.int64)
+            freq_sum = np.zeros(len(items))
+
+            rows_per_block = max(1, block_size // max(len(items), 1))
+            for start in range(0, self.k, rows_per_block):
+                rows = np.arange(start, min(start + rows_per_block, self.k))[:, None]
+                freq_sum += self.sketch[rows, self.hash(rows, items[None, :])].sum(axis=0)
+
+            return (self.m / (self.m - 1)) * ((1 / self.k) * freq_sum - (self.n / self.m))
+
+    def merge(self, other):
+        """
+        Add the reports aggregated by another sketch with the same parameters and hash functions
+
+        Note: 
+        Aggregation is a sum over reports, so sketches built from disjoint 
+        shards of clients can be merged in any grouping
+        """
+        if (self.epsilon, self.k, self.m) != (other.epsilon, other.k, other.m) \
+            or not (np.array_equal(self.hash_a, other.hash_a) and np.array_equal(self.hash_b, other.hash_b)):
+            raise ValueError("Cannot merge sketches with different parameters or hash functions")
+
+        self.sketch += other.sketch
+        self.n += other.n
+        return self
+
+    def save(self, fn):
+        with open(fn, 'wb') as f:
+            np.savez(
+                f,
+                params=np.array([self.epsilon, self.k, self.m, self.hash_seed, self.n], dtype=np.float64),
+                hash_a=self.hash_a,
+                hash_b=self.hash_b,
+                sketch=self.sketch
+            )
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as arrays:
+            epsilon, k, m, hash_seed, n = arrays['params']
+            sketch = cls(float(epsilon), int(k), int(m), int(hash_seed))
+            sketch.hash_a = arrays['hash_a']
+            sketch.hash_b = arrays['hash_b']
+            sketch.sketch = arrays['sketch']
+            sketch.n = int(n)
+        return sketch
+
+def _aggregate_shard(params, items, counts, seed_seq):
+    """
+    Privatise and aggregate one shard of client reports into a new sketch, 
+    returning the sketch and its profile
+    """
+    with instrument.collect() as profile:
+        sketch = CountMeanSketch(*params)
+        sketch.privatise_aggregate(items, np.random.default_rng(seed_seq), counts)
+    return sketch, profile
+
+def sharded_privatise_aggregate(sketch, shards, seed=None, n_workers=1, shard_counts=None):
+    """
+    Privatise and aggregate shards of client reports in separate sketches, 
+    then merge them into sketch
+
+    shard_counts: number of reports of each item of each shard (see privatise_aggregate)
+
+    Note: 
+    Each shard has its own RNG stream spawned from seed and shard sketches are merged 
+    in shard order, so the result for a given seed and set of shards does not depend on n_workers
+    """
+    shard_seeds = np.random.SeedSequence(seed).spawn(len(shards))
+    params = [(sketch.epsilon, sketch.k, sketch.m, sketch.hash_seed)] * len(shards)
+    if shard_counts is None:
+        shard_counts = [None] * len(shards)
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for shard_sketch, profile in pool.map(_aggregate_shard, params, shards, shard_counts, shard_seeds):
+                instrument.merge(profile)
+                sketch.merge(shard_sketch)
+    else:
+        for shard_sketch, profile in map(_aggregate_shard, params, shards, shard_counts, shard_seeds):
+            instrument.merge(profile)
+            sketch.merge(shard_sketch)
+
+    return sketch
@@ -0,0 +1,32 @@
+import sys
+import polars as pl
+from clean_mob import division_geoids, densify
+from table_io import read_table, write_table
+
+def main():
+
+    # Sparse cleaned flows
+    mob = read_table(sys.argv[1],
+                     columns=[
+                         "geoid_o",
+                         "geoid_d",
+                         "pop_flows"],
+                     dtypes={
+                         'geoid_o': pl.Utf8,
+                         'geoid_d': pl.Utf8
+                       })
+
+    pop = read_table(
+        sys.argv[2],
+        columns=["GEOID"],
+        dtypes={'GEOID': pl.Utf8}
+    )
+
+    division_lu = read_table(sys.argv[3])
+
+    geoids = division_geoids(pop, division_lu, sys.argv[4])
+
+    write_table(densify(mob, geoids), sys.argv[5])
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
 import polars as pl
 import numpy as np
 import powerlaw
 from alive_progress import alive_bar
+import instrument
+from result_cache import cache_from_env, file_fingerprint, source_fingerprint
+from table_io import read_table, write_table
 
 def calc_waiting_time(beta, tau):
     return powerlaw.Power_Law(0, parameters=[1.+ beta, 1.0/tau]).generate_random(1)[0]
@@ -10,97 +15,393 @@ def calc_waiting_time(beta, tau):
 def preferential_exploration(current_location, pij_weights):
     """
     Preferential exploration based on gravity model
-
-    Note: 
-    Choosing a destination is based on weights (horizontal). 
-    But here, ordering of dictionary keys (vertical) is used for destination names
-    This speeds up destination lookup, but requires that the dictionary keys 
-    have the same ordering as the column names in the pij dataframe
     """
-    weights = np.array(pij_weights[current_location])
-    return np.random.choice(list(pij_weights.keys()), size=1, p=weights)[0]
+    code = pij_weights.codes[current_location]
+    return pij_weights.geoids[pij_weights.sample(code, np.random.uniform(0, 1))]
 
-def preferential_return(trips):
+def preferential_return(history):
     """
     Preferential return based on frequency of previously visited locations
 
-    Weight is based on the number of times a location has been visited
+    Weight is based on the number of times a location has been visited.
+    Choosing uniformly among all previous visits is equivalent to choosing 
+    among distinct locations weighted by their number of visits
     """
-    
-    weights = np.unique(trips[:, 1], return_counts=True)[1]
-    weights = weights / np.sum(weights)
+    return history[np.random.randint(len(history))]
 
-    return np.random.choice(np.unique(trips[:, 1]), size=1, p=weights)[0]
-
-def choose_next_location(trips, pij_weights, rho, gamma):
+def choose_next_location(history, visit_counts, pij_weights, rho, gamma):
     """
     Choose next location based on whether to explore or return
     """
 
-    current_location = trips[-1][1]    
-    n_visited_locations = len(np.unique(trips[:, 1]))
+    current_location = history[-1]
+    n_visited_locations = len(visit_counts)
 
     p_new = np.random.uniform(0, 1)
     if (p_new <= rho * np.power(n_visited_locations, -gamma)) \
         or (n_visited_locations == 1):
+        instrument.count('exploration_draws')
         return preferential_exploration(current_location, pij_weights)
     else:
-        return preferential_return(trips)
+        instrument.count('return_draws')
+        return preferential_return(history)
 
-def depr(uid, start_location, pij_weights, rho, gamma, beta, tau, duration, all_trips, trip_counter):
+def depr(uid, start_location, pij_weights, rho, gamma, beta, tau, duration, all_trips, update_history=False):
     """
     Simulate a single individual based on the DEPR model
+
+    Note:
+    By default the visit history is only the start location, as in the original model, 
+    so every trip explores from the start location. With update_history, each trip 
+    is added to the visit history and visit counts incrementally, 
+    so each step costs O(1) regardless of the number of previous trips
     """
 
     total_time = 0
-    trips = np.array([(0, start_location)])
+    history = [start_location]
+    visit_counts = {start_location: 1}
     while total_time < duration:
         time_to_next_visit = calc_waiting_time(beta, tau)
-        next_location = choose_next_location(trips, pij_weights, rho, gamma)
+        next_location = choose_next_location(history, visit_counts, pij_weights, rho, gamma)
         total_time += time_to_next_visit
 
         if total_time < duration: 
-            all_trips[trip_counter] = (uid, total_time, next_location)
-            trip_counter += 1
+            all_trips.append(uid, total_time, pij_weights.codes[next_location])
+            if update_history:
+                history.append(next_location)
+                visit_counts[next_location] = visit_counts.get(next_location, 0) + 1
         else:
             break
 
-    return trip_counter
-
-def population_depr(pop_sample, pij_weights, rho, gamma, beta, tau, duration):
+def population_depr(pop_sample, pij_weights, rho, gamma, beta, tau, duration, update_history=False):
     """
-    Simulate a population of individuals based on the DEPR model
-
-    Note: 
-    Pre-allocates memory based on the assumption that each individual will make 10 trips 
-    This is an optimization dependent on duration and waiting time distribution
-    Too many trips per-individual will raise a ValueError
+    Simulate a population of individuals based on the DEPR model (see depr for update_history)
     """
 
     n_uids = pop_sample['pop_sample'].sum()
-    
-    max_trips = n_uids * 10 
 
-    all_trips = np.zeros(max_trips, dtype=[('uid', 'i4'), ('time', 'f4'), ('geoid', 'U10')])
+    all_trips = TripBuffer(pij_weights.geoids)
 
     uid = 0
-    trip_counter = 0
 
-    with alive_bar(n_uids) as bar:
+    with alive_bar(n_uids) as bar, instrument.stage('depr'):
         for row in pop_sample.to_dicts():
             if row['pop_sample']:
                 for _ in range(row['pop_sample']):
-                    trip_counter = depr(uid, row['GEOID'], pij_weights, rho, gamma, beta, tau, duration, all_trips, trip_counter)
-                    
-                    if trip_counter > max_trips:
-                        raise ValueError("Exceeded pre-allocated trip storage.")
-                    
+                    depr(uid, row['GEOID'], pij_weights, rho, gamma, beta, tau, duration, all_trips, update_history)
                     uid += 1
                     bar()
     
-    all_trips = all_trips[:trip_counter] # trim unused memory
-    
-    return pl.DataFrame(all_trips)
+    with instrument.stage('trips_to_frame'):
+        return all_trips.to_frame()
+
+class TripBuffer:
+    """
+    Growable store of trips in typed chunks: int32 uid, float32 time and int32 geoid code
+
+    geoids maps geoid codes back to geoids when the trips are converted to a dataframe
+
+    Note: 
+    Single trips are written into fixed size chunks and whole arrays of trips are kept 
+    as chunks of their own, so the buffer never runs out of space and is never copied as it grows
+    """
+
+    def __init__(self, geoids, chunk_size=65_536):
+        self.geoids = geoids
+        self.chunk_size = chunk_size
+        self._chunks = []
+        self._chunk = None
+        self._fill = 0
+
+    def __len__(self):
+        return sum(len(uid) for uid, _, _ in self._chunks) + self._fill
+
+    def _flush(self):
+        if self._fill:
+            self._chunks.append(tuple(column[:self._fill] for column in self._chunk))
+        self._chunk = None
+        self._fill = 0
+
+    def append(self, uid, time, code):
+        if self._chunk is None or self._fill == self.chunk_size:
+            self._flush()
+            self._chunk = (
+                np.empty(self.chunk_size, dtype=np.int32),
+                np.empty(self.chunk_size, dtype=np.float32),
+                np.empty(self.chunk_size, dtype=np.int32)
+            )
+        self._chunk[0][self._fill] = uid
+        self._chunk[1][self._fill] = time
+        self._chunk[2][self._fill] = code
+        self._fill += 1
+
+    def extend(self, uids, times, codes):
+        self._flush()
+        self._chunks.append((
+            uids.astype(np.int32, copy=False), 
+            times.astype(np.float32, copy=False), 
+            codes.astype(np.int32, copy=False)
+        ))
+
+    def to_frame(self) -> pl.DataFrame:
+        """
+        Combine all chunks into a dataframe of uid, time and geoid
+        """
+        self._flush()
+        if self._chunks:
+            uids, times, codes = (np.concatenate(column) for column in zip(*self._chunks))
+        else:
+            uids, times, codes = (np.array([], dtype=dtype) for dtype in (np.int32, np.float32, np.int32))
+
+        return pl.DataFrame({
+            'uid': uids,
+            'time': times,
+            'geoid': pl.Series(self.geoids, dtype=pl.Utf8)[codes]
+        }, schema={'uid': pl.Int32, 'time': pl.Float32, 'geoid': pl.Utf8})
+
+def calc_waiting_times(beta, tau, size, rng):
+    """
+    Draw waiting times for many individuals at once
+
+    Note:
+    Matches calc_waiting_time, which draws from a continuous powerlaw.Power_Law 
+    with xmin=1 and alpha=1+beta by inverse transform sampling. 
+    tau is accepted for parity with calc_waiting_time but (as there) has no effect
+    """
+    return (1 - rng.random(size)) ** (-1 / beta)
+
+def batch_preferential_exploration(current_locations, pij_weights, rng):
+    """
+    Preferential exploration for many individuals at once
+    """
+    return pij_weights.sample(current_locations, rng.random(len(current_locations)))
+
+def batch_preferential_return(history, rows, n_history, rng):
+    """
+    Preferential return for many individuals at once, 
+    choosing uniformly among the previous visits of each individual (see preferential_return)
+    """
+    idx = (rng.random(len(rows)) * n_history).astype(np.int64)
+    return history[rows, idx]
+
+class VisitCounts:
+    """
+    Visit counts of (individual, location) pairs in an open addressing hash table
+
+    Note: 
+    Every individual in a batch adds one key, so a batch of keys is unique and can be 
+    inserted with vectorized linear probing. The table doubles in size to stay at most half full
+    """
+
+    def __init__(self, n_locations, capacity=1024):
+        self.n_locations = n_locations
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        bits = max(int(np.ceil(np.log2(capacity))), 4)
+        self.shift = np.uint64(64 - bits)
+        self.mask = (1 << bits) - 1
+        self.keys = np.full(1 << bits, -1, dtype=np.int64)
+        self.counts = np.zeros(1 << bits, dtype=np.int32)
+
+    def _probe(self, keys):
+        """
+        Find the slot of each key, claiming an empty slot for keys not yet in the table
+        """
+        slots = ((keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> self.shift).astype(np.int64)
+        is_new = np.zeros(len(keys), dtype=bool)
+
+        pending = np.arange(len(keys))
+        while len(pending):
+            s = slots[pending]
+            k = keys[pending]
+            current = self.keys[s]
+            empty = current == -1
+
+            # When several keys claim the same empty slot, one of the writes wins
+            self.keys[s[empty]] = k[empty]
+            claimed = empty & (self.keys[s] == k)
+            is_new[pending[claimed]] = True
+
+            pending = pending[~((current == k) | claimed)]
+            slots[pending] = (slots[pending] + 1) & self.mask
+
+        return slots, is_new
+
+    def add(self, rows, locations):
+        """
+        Record a visit of each individual in rows to its location, 
+        returning whether it is the first visit to that location
+        """
+        if 2 * (self.size + len(rows)) > len(self.keys):
+            occupied = self.keys != -1
+            keys, counts = self.keys[occupied], self.counts[occupied]
+            self._allocate(4 * (self.size + len(rows)))
+            slots, _ = self._probe(keys)
+            self.counts[slots] = counts
+
+        slots, is_new = self._probe(rows.astype(np.int64) * self.n_locations + locations)
+        self.counts[slots] += 1
+        self.size += int(is_new.sum())
+
+        return is_new
+
+def cohort_depr(homes, pij_weights, rho, gamma, beta, tau, duration, rng, update_history=False):
+    """
+    Simulate a cohort of individuals based on the DEPR model, moving all 
+    individuals forward one trip at a time with array operations
+
+    Returns arrays of (cohort index, time, location code) for every trip
+
+    Note:
+    As in depr, histories only hold the home location unless update_history is set
+    """
+
+    n = len(homes)
+    rows = np.arange(n)
+
+    history = np.zeros((n, 16), dtype=np.int32)
+    history[:, 0] = homes
+    n_history = np.ones(n, dtype=np.int64)
+    visit_counts = VisitCounts(len(pij_weights.geoids), capacity=4 * n)
+    visit_counts.add(rows, homes)
+    n_visited_locations = np.ones(n, dtype=np.int64)
+    total_time = np.zeros(n, dtype=np.float64)
+
+    trip_rows, trip_times, trip_locations = [], [], []
+
+    active = rows
+    while len(active):
+        with instrument.stage('depr_waiting_times'):
+            total_time[active] += calc_waiting_times(beta, tau, len(active), rng)
+        active = active[total_time[active] < duration]
+        if not len(active):
+            break
+
+        n_visited = n_visited_locations[active]
+        p_new = rng.random(len(active))
+        explore = (p_new <= rho * np.power(n_visited, -gamma, dtype=np.float64)) \
+            | (n_visited == 1)
+
+        current_locations = history[active, n_history[active] - 1]
+        next_locations = np.empty(len(active), dtype=np.int32)
+        with instrument.stage('depr_exploration'):
+            next_locations[explore] = batch_preferential_exploration(
+                current_locations[explore], pij_weights, rng)
+        with instrument.stage('depr_return'):
+            next_locations[~explore] = batch_preferential_return(
+                history, active[~explore], n_history[active[~explore]], rng)
+        instrument.count('exploration_draws', np.count_nonzero(explore))
+        instrument.count('return_draws', len(active) - np.count_nonzero(explore))
+
+        if update_history:
+            with instrument.stage('depr_visit_counts'):
+                n_visited_locations[active] += visit_counts.add(active, next_locations)
+
+            if n_history.max() == history.shape[1]:
+                history = np.pad(history, ((0, 0), (0, history.shape[1])))
+            history[active, n_history[active]] = next_locations
+            n_history[active] += 1
+
+        trip_rows.append(active)
+        trip_times.append(total_time[active].astype(np.float32))
+        trip_locations.append(next_locations)
+
+    if not trip_rows:
+        return (np.array([], dtype=np.int64), 
+                np.array([], dtype=np.float32), 
+                np.array([], dtype=np.int32))
+
+    trip_rows = np.concatenate(trip_rows)
+    order = np.argsort(trip_rows, kind='stable') # trips of each individual in time order
+
+    return (trip_rows[order], 
+            np.concatenate(trip_times)[order], 
+            np.concatenate(trip_locations)[order])
+
+_worker_state = {}
+
+def _init_worker(pij_weights, params, update_history):
+    """
+    Share the pij weights and model parameters with a pool worker once, 
+    rather than pickling them with every shard
+    """
+    _worker_state.update(pij_weights=pij_weights, params=params, update_history=update_history)
+
+def _simulate_shard(homes, seed_seq):
+    """
+    Simulate one shard of individuals with its own RNG stream, 
+    returning its trips and profile
+    """
+    rng = np.random.default_rng(seed_seq)
+    with instrument.collect() as profile, instrument.stage('cohort_depr'):
+        trips = cohort_depr(
+            homes, 
+            _worker_state['pij_weights'], 
+            *_worker_state['params'], 
+            rng, 
+            _worker_state['update_history'])
+    return trips, profile
+
+def population_depr_batched(pop_sample, pij_weights, rho, gamma, beta, tau, duration, seed=None, cohort_size=20_000, n_workers=1, update_history=False):
+    """
+    Simulate a population of individuals based on the DEPR model, 
+    advancing cohorts of individuals together
+
+    Note: 
+    Follows the same explore / return rules, waiting time distribution and 
+    update_history behaviour as population_depr.
+    uids are assigned in the same order as population_depr. 
+    Each cohort is a shard with its own RNG stream spawned from seed, so shards can be 
+    simulated across n_workers processes and the output for a given seed and cohort_size 
+    does not depend on n_workers
+    """
+
+    pop_sample = pop_sample.filter(pl.col('pop_sample') > 0)
+    missing = set(pop_sample['GEOID'].to_list()) - set(pij_weights.codes)
+    if missing:
+        raise ValueError(f"No pij weights for origin locations: {sorted(missing)}")
+
+    homes = np.repeat(
+        pij_weights.encode(pop_sample['GEOID']), 
+        pop_sample['pop_sample'].to_numpy()
+    )
+    n_uids = len(homes)
+
+    starts = range(0, n_uids, cohort_size)
+    shard_seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    shards = [homes[start:start + cohort_size] for start in starts]
+
+    _init_worker(pij_weights, (rho, gamma, beta, tau, duration), update_history)
+
+    all_trips = TripBuffer(pij_weights.geoids)
+
+    with alive_bar(n_uids) as bar:
+        if n_workers > 1:
+            pool = ProcessPoolExecutor(
+                max_workers=n_workers, 
+                initializer=_init_worker, 
+                initargs=(pij_weights, (rho, gamma, beta, tau, duration), update_history)
+            )
+            results = pool.map(_simulate_shard, shards, shard_seeds)
+        else:
+            pool = None
+            results = map(_simulate_shard, shards, shard_seeds)
+
+        # Results arrive in shard order, so uids are offset by the shard start
+        for start, cohort, (trips, profile) in zip(starts, shards, results):
+            cohort_rows, cohort_times, cohort_locations = trips
+            instrument.merge(profile)
+            with instrument.stage('trip_buffer'):
+                all_trips.extend(cohort_rows + start, cohort_times, cohort_locations)
+            bar(len(cohort))
+
+        if pool is not None:
+            pool.shutdown()
+
+    with instrument.stage('trips_to_frame'):
+        return all_trips.to_frame()
 
 
 def sample_population(pop, pop_sample_rate):
@@ -118,29 +419,176 @@ def sample_population(pop, pop_sample_rate):
     return pop
 
 
-def build_pij_weights(pij: pl.DataFrame) -> dict:
-    """
-    Build a dictionary of weights for each origin location
+@dataclass
+class PijWeights:
     """
-    pij = pij.sort(["geoid_o", "geoid_d"])
+    Integer-coded transition matrix in CSR format
 
-    pij = pij.pivot(
-        index="geoid_o", 
-        columns="geoid_d", 
-        values="value",
-        aggregate_function='first'
-    ).fill_null(0)
-    pij_weights = pij[:, 1:] / pij[:, 1:].sum_horizontal()
-    pij_weights = pij_weights.insert_column(0, pij['geoid_o'])
+    geoids: location geoid for each integer code
+    codes: mapping of geoid to integer code
+    indptr: start and end of each origin row in indices / weights
+    indices: destination code of each nonzero weight
+    weights: normalised weight of each nonzero entry
+    cdf: cumulative weights of each row, offset by the row code 
+    prob, alias: optional Walker alias tables, aligned with indices (see build_alias_tables)
 
-    pij_weights_dict = {}
+    Note: 
+    Offsetting row i by i places the rows one after another in [0, n_locations], 
+    so a draw u in [0, 1) from row i is located with a single binary search for u + i. 
+    This is kept in float64 so that the offset does not swamp the precision of the weights
+    """
+    geoids: np.ndarray
+    codes: dict
+    indptr: np.ndarray
+    indices: np.ndarray
+    weights: np.ndarray
+    cdf: np.ndarray
+    prob: np.ndarray = None
+    alias: np.ndarray = None
+
+    def encode(self, geoids) -> np.ndarray:
+        return np.array([self.codes[geoid] for geoid in geoids], dtype=np.int32)
+
+    def sample(self, rows, u):
+        """
+        Draw a destination code from each origin row given uniform draws u
+
+        Note: 
+        Uses the alias tables in O(1) per draw when they have been built, 
+        otherwise a binary search of the row cdf
+        """
+        if self.alias is None:
+            idx = np.searchsorted(self.cdf, u + rows, side='right')
+            return self.indices[idx]
+
+        # Split u into a uniform column within the row and a uniform coin flip
+        start = self.indptr[rows]
+        x = u * (self.indptr[rows + 1] - start)
+        column = x.astype(np.int64)
+        idx = start + column
+        idx = np.where(x - column < self.prob[idx], idx, start + self.alias[idx])
+        return self.indices[idx]
+
+def build_pij_weights(pij: pl.DataFrame) -> PijWeights:
+    """
+    Build an integer-coded, row normalised transition matrix of origin to destination weights
 
-    for row in pij_weights.to_dicts():
-        key = row['geoid_o']
-        values = [row[col] for col in pij_weights.columns[1:]]
-        pij_weights_dict[key] = values
+    Note: 
+    Locations with no positive outgoing weight (for example destinations that are 
+    never origins) are given a self loop, so individuals who explore there stay put
+    """
+    geoids = pl.concat([pij['geoid_o'], pij['geoid_d']]).unique().sort()
+    index = pl.DataFrame({
+        'geoid': geoids, 
+        'code': np.arange(len(geoids), dtype=np.int32)
+    })
+
+    pij = (pij.select(['geoid_o', 'geoid_d', 'value'])
+           .filter(pl.col('value') > 0)
+           .join(index.rename({'geoid': 'geoid_o', 'code': 'o'}), on='geoid_o')
+           .join(index.rename({'geoid': 'geoid_d', 'code': 'd'}), on='geoid_d')
+           .unique(subset=['o', 'd'], keep='first', maintain_order=True)
+           .select(['o', 'd', 'value']))
+
+    absorbing = index.filter(~pl.col('code').is_in(pij['o'])).select(
+        pl.col('code').alias('o'), 
+        pl.col('code').alias('d'), 
+        pl.lit(1.0).alias('value'))
+    
+    pij = (pl.concat([pij, absorbing], how='vertical_relaxed')
+           .sort(['o', 'd'])
+           .with_columns((pl.col('value') / pl.col('value').sum().over('o')).alias('value')))
+
+    rows = pij['o'].to_numpy()
+    weights = pij['value'].to_numpy()
+
+    indptr = np.zeros(len(geoids) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(geoids)))
+
+    cdf = np.cumsum(weights)
+    row_start = np.concatenate([[0.0], cdf[indptr[1:-1] - 1]])
+    cdf = cdf - np.repeat(row_start, np.diff(indptr))
+    cdf[indptr[1:] - 1] = 1.0 # guard against rounding error in the row sums
+    cdf += rows
+
+    geoids = geoids.to_numpy().astype(str)
+
+    return PijWeights(
+        geoids=geoids,
+        codes={geoid: code for code, geoid in enumerate(geoids)},
+        indptr=indptr,
+        indices=pij['d'].to_numpy().astype(np.int32),
+        weights=weights.astype(np.float32),
+        cdf=cdf
+    )
+
+def build_alias_tables(pij_weights: PijWeights) -> PijWeights:
+    """
+    Build Walker alias tables for every origin row (Vose's method)
 
-    return pij_weights_dict
+    prob[j] is the probability of keeping column j of a row, 
+    otherwise the draw moves to column alias[j] of the same row
+    """
+    prob = np.ones(len(pij_weights.indices), dtype=np.float64)
+    alias = np.zeros(len(pij_weights.indices), dtype=np.int32)
+
+    for start, end in zip(pij_weights.indptr[:-1], pij_weights.indptr[1:]):
+        scaled = pij_weights.weights[start:end].astype(np.float64) * (end - start)
+        small = list(np.flatnonzero(scaled < 1))
+        large = list(np.flatnonzero(scaled >= 1))
+        row_prob = prob[start:end]
+        row_alias = alias[start:end]
+        row_alias[:] = np.arange(end - start)
+
+        while small and large:
+            s, l = small.pop(), large.pop()
+            row_prob[s] = scaled[s]
+            row_alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+        
+        # Anything left over is 1 up to rounding error
+        row_prob[small] = 1.0
+        row_prob[large] = 1.0
+
+    return replace(pij_weights, prob=prob, alias=alias)
+
+def save_pij_weights(pij_weights: PijWeights, fn):
+    """
+    Save pij weights (and alias tables, if built) to a .npz file
+    """
+    arrays = {
+        'geoids': pij_weights.geoids,
+        'indptr': pij_weights.indptr,
+        'indices': pij_weights.indices,
+        'weights': pij_weights.weights,
+        'cdf': pij_weights.cdf
+    }
+    if pij_weights.alias is not None:
+        arrays.update(prob=pij_weights.prob, alias=pij_weights.alias)
+
+    with open(fn, 'wb') as f:
+        np.savez(f, **arrays)
+
+def load_pij_weights(fn) -> PijWeights:
+    """
+    Load pij weights saved with save_pij_weights
+    """
+    with np.load(fn) as arrays:
+        geoids = arrays['geoids']
+        return PijWeights(
+            geoids=geoids,
+            codes={geoid: code for code, geoid in enumerate(geoids)},
+            indptr=arrays['indptr'],
+            indices=arrays['indices'],
+            weights=arrays['weights'],
+            cdf=arrays['cdf'],
+            prob=arrays['prob'] if 'prob' in arrays else None,
+            alias=arrays['alias'] if 'alias' in arrays else None
+        )
 
 if __name__ == '__main__':
 
@@ -150,41 +598,66 @@ if __name__ == '__main__':
     BETA = 0.8
     TAU = 17
     DURATION = 24
-
-    pop = pl.read_csv(
-        sys.argv[1],
-        columns=['GEOID', 'POPESTIMATE2019'],
-        dtypes={'GEOID': pl.Utf8}
-    )
-
-    pij = pl.read_csv(
-        sys.argv[2],
-        columns=['geoid_o', 'geoid_d', 'value'],
-        dtypes={'geoid_o': pl.Utf8, 'geoid_d': pl.Utf8}
-    )
-
-    # Get a list of unique first 2 characters of geoid_o from pij (state)
-    # then filter pop to only include those geoids
-    states = pij['geoid_o'].str.slice(0, 2).unique().to_list()
-    pop = pop.filter(pop['GEOID'].str.slice(0, 2).is_in(states))
-
-    pop_sample = sample_population(pop, POP_SAMPLE_RATE)
-
-    print(f"Simulating {pop_sample['pop_sample'].sum():,} individuals")
-
-    pij_weights = build_pij_weights(pij)
-
-    all_trips = population_depr(
-        pop_sample, 
-        pij_weights, 
-        RHO, 
-        GAMMA, 
-        BETA, 
-        TAU, 
-        DURATION
-    )
-
-    all_trips.write_csv(sys.argv[-1])
+    SEED = 1
+    N_WORKERS = int(sys.argv[3])
+
+    cache = cache_from_env()
+    pij_fingerprint = cache.fingerprint(sys.argv[2]) if cache else file_fingerprint(sys.argv[2])
+
+    # Each set of pij weights (date and division) has its own RNG streams,
+    # so simulations of consecutive dates of a division are independent
+    seed = [SEED, int(pij_fingerprint[:16], 16)]
+
+    # Simulations of identical inputs and parameters are reused from the result cache
+    all_trips = None
+    if cache is not None:
+        key = cache.key(
+            pop=cache.fingerprint(sys.argv[1]),
+            pij_weights=pij_fingerprint,
+            source=source_fingerprint('depr'),
+            params=(POP_SAMPLE_RATE, RHO, GAMMA, BETA, TAU, DURATION),
+            seed=seed
+        )
+        all_trips = cache.get(key)
+
+    if all_trips is None:
+        pop = read_table(
+            sys.argv[1],
+            columns=['GEOID', 'POPESTIMATE2019'],
+            dtypes={'GEOID': pl.Utf8}
+        )
+
+        with instrument.stage('load_pij_weights'):
+            pij_weights = load_pij_weights(sys.argv[2])
+
+        # Get a list of unique first 2 characters of geoids from pij (state)
+        # then filter pop to only include those geoids
+        states = list({geoid[:2] for geoid in pij_weights.geoids})
+        pop = pop.filter(pop['GEOID'].str.slice(0, 2).is_in(states))
+
+        pop_sample = sample_population(pop, POP_SAMPLE_RATE)
+
+        print(f"Simulating {pop_sample['pop_sample'].sum():,} individuals")
+
+        all_trips = population_depr_batched(
+            pop_sample, 
+            pij_weights, 
+            RHO, 
+            GAMMA, 
+            BETA, 
+            TAU, 
+            DURATION,
+            seed=seed,
+            n_workers=N_WORKERS
+        )
+
+        if cache is not None:
+            cache.put(key, all_trips)
+
+    with instrument.stage('write_table'):
+        write_table(all_trips, sys.argv[-1])
+
+    instrument.write_profile(sys.argv[-1], n_workers=N_WORKERS, seed=seed)
 
 
 
@@ -1,9 +1,13 @@
-import sys
+import click
 import polars as pl
 import numpy as np
+from sklearn.neighbors import BallTree
+from table_io import read_table, write_table
+
+EARTH_RADIUS = 6371.0
 
 def haversine(lat1, lon1, lat2, lon2):
-    R = 6371.0
+    R = EARTH_RADIUS
 
     lat1_rad, lon1_rad, lat2_rad, lon2_rad = map(np.radians, [lat1, lon1, lat2, lon2])
 
@@ -15,41 +19,130 @@ def haversine(lat1, lon1, lat2, lon2):
 
     return R * c
 
-def main():
+def all_pairs(n, upper=False):
+    """
+    Index pairs of all n points, or only the upper triangle (including the diagonal)
+    """
+    if upper:
+        return np.triu_indices(n)
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    return i.ravel(), j.ravel()
+
+def group_pairs(groups, upper=False):
+    """
+    Index pairs of points in the same group, points with a negative group are dropped
+    """
+    i, j = [], []
+    for group in np.unique(groups[groups >= 0]):
+        members = np.flatnonzero(groups == group)
+        group_i, group_j = all_pairs(len(members), upper)
+        i.append(members[group_i])
+        j.append(members[group_j])
+    if not i:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(i), np.concatenate(j)
+
+def radius_pairs(lat, lng, max_distance, upper=False):
+    """
+    Index pairs of points within max_distance (km) of each other, found with a BallTree
+    """
+    tree = BallTree(np.radians(np.column_stack([lat, lng])), metric='haversine')
+    neighbours = tree.query_radius(np.radians(np.column_stack([lat, lng])), r=max_distance / EARTH_RADIUS)
+    i = np.repeat(np.arange(len(lat)), [len(n) for n in neighbours])
+    j = np.concatenate(neighbours)
+    if upper:
+        i, j = i[i <= j], j[i <= j]
+    order = np.lexsort([j, i])
+    return i[order], j[order]
+
+def distance_pairs(lat, lng, groups=None, max_distance=None, upper=False):
+    """
+    Index pairs and distances between points
+
+    groups: optional integer group of each point (negative for none), only pairs within a group are kept
+    max_distance: optional cutoff (km), only pairs within the cutoff are kept
+    upper: only keep the upper triangle (i <= j) of the symmetric matrix
+    """
+    if max_distance is not None:
+        i, j = radius_pairs(lat, lng, max_distance, upper)
+        if groups is not None:
+            same_group = (groups[i] == groups[j]) & (groups[i] >= 0)
+            i, j = i[same_group], j[same_group]
+    elif groups is not None:
+        i, j = group_pairs(groups, upper)
+    else:
+        i, j = all_pairs(len(lat), upper)
+
+    return i, j, haversine(lat[i], lng[i], lat[j], lng[j])
+
+@click.command()
+@click.argument('centroids_fn')
+@click.argument('pop_fn')
+@click.argument('outfn')
+@click.option('--divisions', help='Division lookup (STATE, SUBDIVISION), only keep pairs within a division')
+@click.option('--within-state', is_flag=True, help='Only keep pairs within a state')
+@click.option('--max-distance', type=float, help='Only keep pairs within this distance (km)')
+@click.option('--upper', is_flag=True, help='Only keep the upper triangle of the symmetric matrix')
+@click.option('--sparse', is_flag=True, help='Only write GEOID pairs and distance, without coordinates')
+def main(centroids_fn, pop_fn, outfn, divisions, within_state, max_distance, upper, sparse):
 
-    centroids = pl.read_csv(
-        sys.argv[1],
+    centroids = read_table(
+        centroids_fn,
         columns=['GEOID', 'lat', 'lng'],
         dtypes={'GEOID': pl.Utf8}
     )
 
-    pop = pl.read_csv(
-        sys.argv[2], 
+    pop = read_table(
+        pop_fn,
         columns=["GEOID", "POPESTIMATE2019"],
         dtypes={'GEOID': pl.Utf8}
     )
-    
-    pop = pop.sort("GEOID")
 
-    dist = centroids.join(centroids, how='cross')
+    # Some counties are missing population data
+    centroids = centroids.filter(centroids["GEOID"].is_in(pop["GEOID"]))
 
-    dist = dist.rename({
-        'GEOID': 'GEOID_origin', 
-        'GEOID_right': 'GEOID_dest',
-        'lat': 'lat_origin',
-        'lng': 'lng_origin',
-        'lat_right': 'lat_dest',
-        'lng_right': 'lng_dest'
-        })
-        
-    distances = haversine(dist['lat_origin'], dist['lng_origin'], dist['lat_dest'], dist['lng_dest'])
+    centroids = centroids.with_columns(pl.col('GEOID').str.slice(0, 2).alias('STATE'))
 
-    dist = dist.with_columns(distances.alias('distance'))
+    group_columns = []
+    if divisions:
+        division_lu = read_table(divisions, dtypes={'STATE': pl.Utf8, 'SUBDIVISION': pl.Utf8})
+        division_lu = division_lu.with_columns(pl.col('STATE').str.zfill(2))
+        centroids = centroids.join(
+            division_lu.select(['STATE', 'SUBDIVISION']), on='STATE', how='left'
+        )
+        group_columns.append('SUBDIVISION')
+    if within_state:
+        group_columns.append('STATE')
 
-    # Some counties are missing population data
-    dist = dist.filter(dist["GEOID_origin"].is_in(pop["GEOID"]) & dist["GEOID_dest"].is_in(pop["GEOID"]))
+    groups = None
+    if group_columns:
+        # Integer code of each group, -1 for counties outside any division
+        groups = centroids.select(
+            (pl.concat_str(group_columns, separator='_').rank('dense') - 1)
+            .fill_null(-1)
+        ).to_series().to_numpy()
+
+    lat = centroids['lat'].to_numpy()
+    lng = centroids['lng'].to_numpy()
+
+    i, j, distances = distance_pairs(lat, lng, groups, max_distance, upper)
+
+    geoid = centroids['GEOID']
+
+    dist = pl.DataFrame({
+        'lng_origin': lng[i],
+        'lat_origin': lat[i],
+        'GEOID_origin': geoid[i],
+        'lng_dest': lng[j],
+        'lat_dest': lat[j],
+        'GEOID_dest': geoid[j],
+        'distance': distances
+    })
+
+    if sparse:
+        dist = dist.select(['GEOID_origin', 'GEOID_dest', 'distance'])
 
-    dist.write_csv(sys.argv[3])
+    write_table(dist, outfn)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,155 @@
+import math
+import numpy as np
+import polars as pl
+
+def od_summary(depr):
+    """
+    Summary statistics of OD trips (uid, geoid_o, geoid_d) for predicting privacy error:
+    the count of each OD pair and the number of trips of each uid
+    """
+    counts = depr.group_by(['geoid_o', 'geoid_d']).agg(pl.count())['count'].to_numpy()
+    trips_per_uid = depr.group_by('uid').agg(pl.count())['count'].to_numpy()
+    return counts.astype(np.float64), trips_per_uid
+
+def retention(trips_per_uid, sensitivity):
+    """
+    Expected fraction of trips kept when bounding each uid to sensitivity trips
+    """
+    return np.minimum(trips_per_uid, sensitivity).sum() / trips_per_uid.sum()
+
+def _normal_cdf(x):
+    return 0.5 * (1 + np.vectorize(math.erf)(x / math.sqrt(2)))
+
+def cell_metrics(counts, squared_error, absolute_error):
+    """
+    rmse, weighted_rmse, mape and weighted_mape from the expected squared and
+    absolute error of each OD pair, as computed by calc_privacy_error
+    """
+    weight = counts / counts.sum()
+    absolute_percentage_error = absolute_error / counts * 100
+    return {
+        'rmse': np.sqrt(np.mean(squared_error)),
+        'weighted_rmse': np.sqrt(np.sum(squared_error * weight)) / np.sum(weight),
+        'mape': np.mean(absolute_percentage_error),
+        'weighted_mape': np.sum(absolute_percentage_error * weight) / np.sum(weight)
+    }
+
+def predict_gdp(counts, trips_per_uid, sensitivity, epsilon):
+    """
+    Predicted error metrics of bounded_sum_gdp
+
+    Note:
+    Each trip of an OD pair with count c is kept with probability f (the retention),
+    so the bounded count is approximately Binomial(c, f). Pairs with a nonzero
+    bounded count are released with Laplace(sensitivity / epsilon) noise,
+    other pairs are not released and have an error of c.
+    The absolute error of released pairs ignores the bounding variance
+    """
+    f = retention(trips_per_uid, sensitivity)
+    scale = sensitivity / epsilon
+    released = 1 - (1 - f) ** counts
+    bias = (1 - f) * counts
+
+    squared_error = bias ** 2 + counts * f * (1 - f) + 2 * scale ** 2 * released
+    absolute_error = released * (bias + scale * np.exp(-bias / scale)) + (1 - released) * counts
+
+    return cell_metrics(counts, squared_error, absolute_error)
+
+def predict_cms(counts, trips_per_uid, sensitivity, epsilon, k, m):
+    """
+    Predicted error metrics of freq_cms
+
+    Note:
+    The CMS estimate of a bounded count is unbiased over client noise and hash functions.
+    Client noise adds a variance of (c_eps^2 - 1) / 4 per report. Collisions add
+    (1/m)(1 - 1/m)(c_a (1 - 1/k) + c_a^2 / k) for every other item a, as reports of
+    an item share its k hash functions. Errors are taken to be normal about the bounding bias
+    """
+    f = retention(trips_per_uid, sensitivity)
+    bounded = f * counts
+    n = bounded.sum()
+
+    c_eps = (math.exp(epsilon / 2) + 1) / (math.exp(epsilon / 2) - 1)
+    q = 1 / m
+    other = (n - bounded) * (1 - 1 / k) + (np.sum(bounded ** 2) - bounded ** 2) / k
+    variance = (m / (m - 1)) ** 2 * (n * (c_eps ** 2 - 1) / 4 + q * (1 - q) * other) \
+        + counts * f * (1 - f)
+
+    bias = (1 - f) * counts
+    sd = np.sqrt(variance)
+
+    squared_error = bias ** 2 + variance
+    absolute_error = sd * math.sqrt(2 / math.pi) * np.exp(-bias ** 2 / (2 * variance)) \
+        + bias * (1 - 2 * _normal_cdf(-bias / sd))
+
+    return cell_metrics(counts, squared_error, absolute_error)
+
+def predict_grid(counts, trips_per_uid, construction, configs) -> pl.DataFrame:
+    """
+    Predicted error metrics of each (sensitivity, epsilon, k, m) configuration of a construction
+    """
+    predictions = []
+    for s, e, k, m in configs:
+        if construction == "GDP":
+            metrics = predict_gdp(counts, trips_per_uid, int(s), float(e))
+        else:
+            metrics = predict_cms(counts, trips_per_uid, int(s), float(e), int(k), int(m))
+        predictions.append({'construction': construction, 'k': k, 'm': m, 'epsilon': e, 'sensitivity': s, **metrics})
+
+    return pl.DataFrame(predictions, schema={
+        'construction': pl.Utf8,
+        'k': pl.Utf8,
+        'm': pl.Utf8,
+        'epsilon': pl.Utf8,
+        'sensitivity': pl.Utf8,
+        'rmse': pl.Float64,
+        'weighted_rmse': pl.Float64,
+        'mape': pl.Float64,
+        'weighted_mape': pl.Float64
+    })
+
+def frontier(predictions, metric, acceptable, band=1.0, max_runs=8) -> pl.DataFrame:
+    """
+    Configurations predicted to be near the acceptable error frontier
+
+    Keeps configurations whose predicted metric is within a factor of (1 + band)
+    of the acceptable value, at most max_runs of them, closest first
+
+    Note:
+    If no configuration is within the band (e.g. every configuration of a grid 
+    is predicted to be far worse than acceptable), the max_runs configurations 
+    closest to the acceptable value are kept instead
+    """
+    distance = (pl.col(metric) / acceptable).log().abs()
+    near = predictions.filter(distance <= math.log(1 + band))
+    if not near.height:
+        near = predictions
+    return near.sort(distance).head(max_runs)
+
+def calibrate(predictions, simulated, metric):
+    """
+    Scale predictions of metric by the ratio of simulated to predicted values 
+    of calibration configurations, returning the predictions with 
+    {metric}_simulated and {metric}_calibrated columns and the spread of the ratios
+
+    simulated: simulated metric of each calibration configuration, by (sensitivity, epsilon, k, m)
+
+    Note:
+    The scale is the geometric mean ratio. The spread is the largest factor 
+    (as a log) by which a calibration configuration differs from its calibrated 
+    prediction, i.e. how far calibrated predictions can still be trusted
+    """
+    configs = list(predictions.select(['sensitivity', 'epsilon', 'k', 'm']).iter_rows())
+    simulated = [simulated.get(config) for config in configs]
+
+    log_ratio = np.array([
+        math.log(sim / pred) for sim, pred in zip(simulated, predictions[metric]) 
+        if sim is not None and sim > 0 and pred > 0
+    ])
+    shift = log_ratio.mean() if len(log_ratio) else 0.0
+    spread = np.abs(log_ratio - shift).max() if len(log_ratio) else 0.0
+
+    return predictions.with_columns([
+        pl.Series(f'{metric}_simulated', simulated, dtype=pl.Float64),
+        (pl.col(metric) * math.exp(shift)).alias(f'{metric}_calibrated')
+    ]), spread
@@ -0,0 +1,11 @@
+import sys
+from table_io import read_table, write_table
+
+def main():
+    """
+    Export a table in any supported format as CSV, for the R scripts
+    """
+    write_table(read_table(sys.argv[1]), sys.argv[-1])
+
+if __name__ == '__main__':
+    main()
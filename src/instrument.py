@@ -0,0 +1,81 @@
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# Timers and counters of the current process (or of the block in collect())
+_profile = {'stages': {}, 'counters': {}}
+
+_start = time.perf_counter()
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+@contextmanager
+def stage(name):
+    """
+    Time a block of code, adding to the calls and seconds of stage name
+
+    Note:
+    peak_rss_mb of a stage is the peak RSS of the process when the stage last ended,
+    so a jump between consecutive stages shows which one raised the peak
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = _profile['stages'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0})
+        timer['calls'] += 1
+        timer['seconds'] += time.perf_counter() - start
+        timer['peak_rss_mb'] = max(timer['peak_rss_mb'], peak_rss_mb())
+
+def count(name, n=1):
+    """
+    Add n to counter name
+    """
+    _profile['counters'][name] = _profile['counters'].get(name, 0) + int(n)
+
+def merge(profile):
+    """
+    Add the timers and counters of another profile (i.e. from a pool worker)
+    """
+    for name, other in profile['stages'].items():
+        timer = _profile['stages'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0})
+        timer['calls'] += other['calls']
+        timer['seconds'] += other['seconds']
+        timer['peak_rss_mb'] = max(timer['peak_rss_mb'], other['peak_rss_mb'])
+    for name, n in profile['counters'].items():
+        count(name, n)
+
+@contextmanager
+def collect():
+    """
+    Collect the timers and counters of a block in a separate profile,
+    which can be returned from a pool worker and merged by the parent
+    """
+    global _profile
+    outer, _profile = _profile, {'stages': {}, 'counters': {}}
+    try:
+        yield _profile
+    finally:
+        _profile = outer
+
+def write_profile(outfn, **metadata):
+    """
+    Write timers, counters and peak RSS as JSON next to an output file (outfn.profile.json)
+    """
+    with open(f"{outfn}.profile.json", 'w') as f:
+        json.dump({
+            'output': str(outfn),
+            **metadata,
+            'seconds': time.perf_counter() - _start,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': _profile['stages'],
+            'counters': _profile['counters']
+        }, f, indent=2)
@@ -0,0 +1,165 @@
+import polars as pl
+from table_io import scan_table, table_format
+
+def scan_trajectories(fn) -> pl.LazyFrame:
+    """
+    Lazily scan simulated trajectories (uid, time, geoid)
+    """
+    return scan_table(
+        fn,
+        dtypes={'geoid': pl.Utf8}
+    ).select(['uid', 'time', 'geoid'])
+
+def scan_trip_batches(fn, batch_size=2**22):
+    """
+    Read trajectories (uid, time, geoid) in batches of about batch_size rows, in file order
+    """
+    if table_format(fn) == 'csv':
+        # All columns are read as strings and cast, as batched reads ignore dtypes by name
+        reader = pl.read_csv_batched(fn, infer_schema_length=0, batch_size=batch_size)
+        batches = reader.next_batches(1)
+        while batches:
+            yield batches[0].select([
+                pl.col('uid').cast(pl.Int64), 
+                pl.col('time').cast(pl.Float64), 
+                pl.col('geoid')
+            ])
+            batches = reader.next_batches(1)
+    else:
+        trajectories = scan_trajectories(fn)
+        offset = 0
+        while True:
+            batch = trajectories.slice(offset, batch_size).collect()
+            if not batch.height:
+                break
+            yield batch
+            offset += batch.height
+
+def od_trip_batches(batches):
+    """
+    OD trips (uid, geoid_o, geoid_d) between consecutive trips of each uid, 
+    one frame for each batch of trajectories (uid, time, geoid)
+
+    Note:
+    The trips of each uid must be in time order, but uids may be interleaved 
+    (e.g. space-time partitions are in day order). The last trip of every uid 
+    seen so far is carried into the next batch, so trips spanning batches are 
+    paired correctly while holding only one batch and one row per uid in memory. 
+    OD trips are ordered by uid within each batch and trips to a null geoid 
+    (a county missing from a cluster lookup) are dropped
+    """
+    last = pl.DataFrame(schema={'uid': pl.Int64, 'time': pl.Float64, 'geoid': pl.Utf8})
+
+    for batch in batches:
+        if not batch.height:
+            continue
+        batch = batch.select([pl.col('uid').cast(pl.Int64), pl.col('time').cast(pl.Float64), 'geoid'])
+        uids = batch.select(pl.col('uid').unique())
+
+        # Carried trips come first, so sorting by uid keeps each uid's trips in file order
+        trips = (pl.concat([last.join(uids, on='uid', how='semi'), batch])
+                 .with_row_count('_row')
+                 .sort(['uid', '_row'])
+                 .drop('_row'))
+
+        same_uid = pl.col('uid') == pl.col('uid').shift(-1)
+        if trips.select((same_uid & (pl.col('time').shift(-1) < pl.col('time'))).any()).item():
+            raise ValueError("Trips of each uid must be ordered by time")
+
+        yield (trips
+               .select([
+                   'uid', 
+                   pl.col('geoid').alias('geoid_o'),
+                   pl.col('geoid').shift(-1).alias('geoid_d'),
+                   same_uid.alias('same_uid')
+               ])
+               .filter(pl.col('same_uid') & pl.col('geoid_d').is_not_null())
+               .drop('same_uid'))
+
+        last = pl.concat([
+            last.join(uids, on='uid', how='anti'), 
+            trips.group_by('uid').agg(pl.col(['time', 'geoid']).last())
+        ])
+
+def read_od_trips(fn, batch_size=2**22) -> pl.DataFrame:
+    """
+    OD trips (uid, geoid_o, geoid_d) of trajectories in fn, see od_trip_batches
+    """
+    od = list(od_trip_batches(scan_trip_batches(fn, batch_size)))
+    if not od:
+        return pl.DataFrame(schema={'uid': pl.Int64, 'geoid_o': pl.Utf8, 'geoid_d': pl.Utf8})
+    return pl.concat(od)
+
+def od_counts_from_batches(batches) -> pl.DataFrame:
+    """
+    Count trips between each origin-destination pair from batches of trajectories, 
+    holding only one batch, the last trip of each uid and the running counts in memory 
+    (see od_trip_batches)
+    """
+    counts = pl.DataFrame(schema={'geoid_o': pl.Utf8, 'geoid_d': pl.Utf8, 'count': pl.UInt32})
+
+    for od in od_trip_batches(batches):
+        counts = (pl.concat([counts, od.group_by(['geoid_o', 'geoid_d']).agg(pl.count().alias('count'))])
+                  .group_by(['geoid_o', 'geoid_d'])
+                  .agg(pl.col('count').sum()))
+
+    return counts.sort(['geoid_o', 'geoid_d'])
+
+def daily_od_counts(trajectories: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Count trips between each origin-destination pair by day, 
+    from trajectories (uid, time, geoid, day) of consecutive days
+
+    Note: 
+    Each trip is assigned to the day of its destination, so a trip spanning a day 
+    boundary is counted in every window containing both days, and the counts of 
+    any window of the first t days are the sum of the daily counts of days < t. 
+    Pairs are within each uid. The R aggregation this replaced shifted over all rows, 
+    adding a trip from the last location of each uid to the first of the next
+    """
+    return (trajectories
+            .sort(['uid', 'time'])
+            .with_columns([
+                pl.col('geoid').shift(-1).over('uid').alias('geoid_d'),
+                pl.col('day').shift(-1).over('uid').alias('day_d')
+            ])
+            .filter(pl.col('day_d').is_not_null())
+            .group_by(['day_d', 'geoid', 'geoid_d'])
+            .agg(pl.count().alias('count'))
+            .rename({'day_d': 'day', 'geoid': 'geoid_o'}))
+
+def roll_up_od(od: pl.LazyFrame, geoid_lu: pl.DataFrame) -> pl.LazyFrame:
+    """
+    Roll county OD counts (day, geoid_o, geoid_d, count) up to the clusters 
+    of every spatial resolution in the lookup (GEOID, k, k_cluster)
+
+    Note: 
+    Counties missing from the lookup at a resolution have a null cluster. 
+    Trips to a null cluster are dropped, as when OD pairs are built from 
+    trajectories remapped to clusters
+    """
+    lu = geoid_lu.select(['GEOID', 'k', 'k_cluster']).lazy()
+    space_ks = geoid_lu.select(pl.col('k').unique()).lazy()
+
+    return (od
+            .join(space_ks, how='cross')
+            .join(lu.rename({'GEOID': 'geoid_o', 'k_cluster': 'cluster_o'}), on=['geoid_o', 'k'], how='left')
+            .join(lu.rename({'GEOID': 'geoid_d', 'k_cluster': 'cluster_d'}), on=['geoid_d', 'k'], how='left')
+            .filter(pl.col('cluster_d').is_not_null())
+            .group_by(['k', 'day', 'cluster_o', 'cluster_d'])
+            .agg(pl.col('count').sum())
+            .rename({'k': 'space', 'cluster_o': 'geoid_o', 'cluster_d': 'geoid_d'}))
+
+def od_windows(cube: pl.DataFrame, time_ts) -> pl.DataFrame:
+    """
+    OD counts over the first t days for each t, summed from a daily OD cube 
+    (space, day, geoid_o, geoid_d, count)
+    """
+    return pl.concat([
+        (cube
+         .filter(pl.col('day') < t)
+         .group_by(['space', 'geoid_o', 'geoid_d'])
+         .agg(pl.col('count').sum())
+         .with_columns(pl.lit(t).alias('t')))
+        for t in time_ts
+    ])
@@ -1,8 +1,8 @@
 import sys
 import polars as pl
 import numpy as np
-from pure_ldp.frequency_oracles.apple_cms import CMSClient, CMSServer
-from alive_progress import alive_bar
+import instrument
+from cms import CountMeanSketch, sharded_privatise_aggregate
 
 def k_anonymous_sum(data, group, T):
     
@@ -10,27 +10,150 @@ def k_anonymous_sum(data, group, T):
             .agg([pl.col('count').sum().alias('count')])
             .filter(pl.col('count') >= T))
 
-def add_laplace_noise(count, epsilon, sensitivity):
+def k_anonymous_sums(data, group, thresholds):
+    """
+    k_anonymous_sum for every threshold T, with the suppression at each threshold
+
+    Note:
+    Counts are summed by group and sorted once. The sums released at threshold T 
+    are the sorted sums from the first sum >= T, so each threshold is a slice of 
+    the same table and suppression is read from cumulative sums of the sorted counts
+    """
+    with instrument.stage('k_anonymous_sums'):
+        sums = (data.groupby(group)
+                .agg([pl.col('count').sum().alias('count')])
+                .sort(['count'] + group))
+
+        counts = sums['count'].to_numpy()
+        suppressed_trips = np.concatenate([[0], np.cumsum(counts)])
+        starts = np.searchsorted(counts, thresholds, side='left')
+
+        suppression = pl.DataFrame({
+            'threshold': thresholds,
+            'n_pairs': len(counts),
+            'n_suppressed': starts,
+            'pair_suppression_rate': starts / max(len(counts), 1),
+            'trips': suppressed_trips[-1],
+            'trips_suppressed': suppressed_trips[starts],
+            'trip_suppression_rate': suppressed_trips[starts] / max(suppressed_trips[-1], 1)
+        })
+
+        return [sums.slice(start) for start in starts], suppression
+
+def add_laplace_noise(count, epsilon, sensitivity, rng=np.random, discrete=False):
+    """
+    Add Laplace noise to a count or an array of counts in one call
+
+    Note:
+    With discrete=True, noise is drawn from the discrete Laplace (two-sided geometric) 
+    distribution as the difference of two geometric draws, so integer counts stay integers
+    """
     scale = sensitivity / epsilon
-    noise = np.random.laplace(0, scale)
+    size = np.shape(count)
+    with instrument.stage('laplace_noise'):
+        if discrete:
+            p = 1 - np.exp(-1 / scale)
+            noise = rng.geometric(p, size=size) - rng.geometric(p, size=size)
+        else:
+            noise = rng.laplace(0, scale, size=size)
+    instrument.count('noise_draws', np.size(noise))
     return count + noise
 
-def sample_n(group: pl.DataFrame, n) -> pl.DataFrame:
-        return group.sample(n=min(n, len(group)), with_replacement=False)
+def bound_contributions(data, sensitivity, rng):
+    """
+    Select at most sensitivity rows per uid, uniformly without replacement
+
+    Note: 
+    Ranking a uniform random key within each uid gives a random permutation of its rows, 
+    so keeping ranks <= sensitivity is a uniform sample without replacement of min(sensitivity, n) rows
+    """
+    with instrument.stage('bound_contributions'):
+        return (data
+                .with_columns(pl.Series('_key', rng.random(data.height)))
+                .filter(pl.col('_key').rank('ordinal').over('uid') <= sensitivity)
+                .drop('_key'))
+
+def bounded_sum(data, group, sensitivity, rng):
+    """
+    Sum counts by group after selecting at most sensitivity rows per uid
+    """
+    data = bound_contributions(data, sensitivity, rng)
+    
+    with instrument.stage('bounded_sum'):
+        return (data.groupby(group, maintain_order=True)
+                .agg([pl.col('count').sum().alias('count')]))
+
+def with_trials(data, n_trials):
+    """
+    Repeat data once per trial, trial by trial, with a trial column
+    """
+    trials = pl.DataFrame({'trial': np.arange(n_trials)}, schema={'trial': pl.Int32})
+    return trials.join(data, how='cross').select(data.columns + ['trial'])
+
+def gdp_noise(data, sensitivity, epsilon, rng, discrete=False, n_trials=1):
+    """
+    Add Laplace noise to the count column of bounded sums, 
+    with independent noise for each of n_trials trials
+
+    Note:
+    Noise for all trials is drawn as one (n_trials, n) matrix. Trials share the 
+    bounded sums, so they vary over noise only, not over bounding
+    """
+    counts = data['count'].to_numpy()
+    counts = np.broadcast_to(counts, (n_trials, len(counts)))
+    return with_trials(data, n_trials).with_columns(
+        pl.Series('count', add_laplace_noise(counts, epsilon, sensitivity, rng, discrete).ravel())
+    )
+
+def bounded_sum_gdp(data, group, sensitivity, epsilon, seed=None, discrete=False):
 
-def bounded_sum_gdp(data, group, sensitivity, epsilon):
+    rng = np.random.default_rng(seed)
 
     # Select total rows per uid <= sensitivity
-    data = data.groupby('uid').apply(lambda x: sample_n(x, sensitivity))
+    data = bounded_sum(data, group, sensitivity, rng)
     
-    data = (data.groupby(group)
-            .agg([pl.col('count').sum().alias('count')]))
+    return gdp_noise(data, sensitivity, epsilon, rng, discrete)
+
+def cms_counts(domain, data, m, k, epsilon, rng, n_shards=1, n_workers=1, n_trials=1, hash_seed=0):
+    """
+    Estimate the count of every od_id in domain from bounded data (uid, od_id) with a CMS
+
+    n_shards: number of shards of uids aggregated into separate sketches, then merged
+    n_workers: number of processes aggregating shards
+    n_trials: number of independent privatisations of the same data
+    hash_seed: seed of the (public) hash functions
+
+    Note:
+    Every trial and shard uses the same hash functions, fixed by hash_seed, as pure_ldp 
+    fixes its hash functions (xxhash seeds 0..k-1) for a given k. Trials vary over client 
+    noise only, so hash collisions are a fixed error of the release. 
+    The bounded data is counted by od_id (per shard) in one pass, and each trial 
+    privatises and aggregates from the counts (see privatise_aggregate)
+    """
+    od_id = data['od_id'].to_numpy()
+    if n_shards > 1:
+        shard = (data['uid'] % n_shards).to_numpy()
+        shards, shard_counts = zip(*[np.unique(od_id[shard == i], return_counts=True) for i in range(n_shards)])
+    else:
+        items, counts = np.unique(od_id, return_counts=True)
+
+    freq = []
+    for _ in range(n_trials):
+        sketch = CountMeanSketch(epsilon, k, m, hash_seed)
+
+        if n_shards > 1:
+            sharded_privatise_aggregate(sketch, list(shards), seed=rng.integers(2**63), n_workers=n_workers, 
+                                        shard_counts=list(shard_counts))
+        else:
+            sketch.privatise_aggregate(items, rng, counts)
+
+        freq.append(sketch.estimate(domain['od_id'].to_numpy()))
     
-    return data.with_columns(
-        pl.col('count').apply(lambda x: add_laplace_noise(x, epsilon, sensitivity)).alias('count')
-    )
+    domain = with_trials(domain, n_trials).with_columns(pl.Series("count", np.concatenate(freq)))
 
-def freq_cms(domain, data, m, k, sensitivity, epsilon):
+    return domain.drop('od_id')
+
+def freq_cms(domain, data, m, k, sensitivity, epsilon, seed=None, n_shards=1, n_workers=1):
     """
     domain: polars dataframe with all pairs of geoid_o and geoid_d
     data: simulated individual trajectories
@@ -38,24 +161,14 @@ def freq_cms(domain, data, m, k, sensitivity, epsilon):
     k: number of hash functions
     v: number of rows per uid
     epsilon: privacy budget
+    seed: seed for selecting rows per uid and privatising reports
+    n_shards, n_workers: see cms_counts
     """     
+    rng = np.random.default_rng(seed)
+
     # Select total rows per uid <= v
-    data = data.groupby('uid').apply(lambda x: sample_n(x, sensitivity))
+    data = bound_contributions(data, sensitivity, rng)
 
     data = data.join(domain, on=['geoid_o', 'geoid_d'], how='left')
 
-    server = CMSServer(epsilon, k, m, is_hadamard=False)
-    client = CMSClient(epsilon, server.get_hash_funcs(), m, is_hadamard=False)
-
-    for od_id in data['od_id'].to_list():
-        server.aggregate(client.privatise(od_id))
-
-    freq = []
-    for od_id in domain['od_id'].to_list():
-        freq.append(server.estimate(od_id))
-    
-    domain = domain.with_columns(pl.Series("count", freq))
-
-    domain = domain.drop('od_id')
-
-    return domain     
+    return cms_counts(domain, data, m, k, epsilon, rng, n_shards, n_workers)
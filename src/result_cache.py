@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+from importlib.util import find_spec
+from pathlib import Path
+import polars as pl
+import instrument
+
+# Bump to invalidate cached results after changes source fingerprints do not cover (e.g. how entries are stored)
+CACHE_VERSION = 6
+
+DEFAULT_CACHE_GB = 20
+
+def file_fingerprint(fn, chunk_size=2**24) -> str:
+    """
+    SHA-256 of the contents of a file
+    """
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+def source_fingerprint(*modules) -> str:
+    """
+    SHA-256 of the source of modules (by name), for cache keys of results they compute
+
+    Note:
+    Any edit to a module changes its fingerprint, so results computed by
+    older code are never returned
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        digest.update(file_fingerprint(find_spec(module).origin).encode())
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Content-addressed cache of DataFrames on disk, keyed by a hash of input
+    fingerprints and parameters, evicting the least recently used entries
+    once the cache is larger than max_bytes
+
+    Note:
+    Entries are parquet files named by their key. Reading an entry updates its
+    modification time, which orders entries for eviction. Entries are written to a
+    temporary file and renamed, so processes sharing a cache never read partial entries
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        (self.directory / 'fingerprints').mkdir(parents=True, exist_ok=True)
+
+    def fingerprint(self, fn) -> str:
+        """
+        Fingerprint of the contents of an input file
+
+        Note:
+        Fingerprints are remembered by path, size and modification time,
+        so unchanged inputs are only hashed once
+        """
+        stat = os.stat(fn)
+        stat_key = hashlib.sha256(
+            f"{os.path.realpath(fn)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        ).hexdigest()
+        memo = self.directory / 'fingerprints' / stat_key
+
+        if memo.exists():
+            return memo.read_text()
+
+        with instrument.stage('cache_fingerprint'):
+            fingerprint = file_fingerprint(fn)
+        memo.write_text(fingerprint)
+        return fingerprint
+
+    def key(self, **params) -> str:
+        """
+        Cache key of a result computed from input fingerprints and parameters
+        """
+        params = json.dumps({'version': CACHE_VERSION, **params}, sort_keys=True, default=str)
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def path(self, key) -> Path:
+        return self.directory / f"{key}.parquet"
+
+    def get(self, key):
+        """
+        Cached result of key, or None
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+            result = pl.read_parquet(path)
+        except FileNotFoundError:
+            instrument.count('cache_misses')
+            return None
+        instrument.count('cache_hits')
+        return result
+
+    def put(self, key, result):
+        """
+        Store the result of key, then evict entries above max_bytes
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            result.write_parquet(tmp)
+            os.replace(tmp, self.path(key))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        for path in self.directory.glob('*.parquet'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                instrument.count('cache_evictions')
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def open_cache(directory, max_gb=DEFAULT_CACHE_GB):
+    """
+    ResultCache in directory, or None if no directory is given
+    """
+    if not directory:
+        return None
+    return ResultCache(directory, max_gb * 2**30)
+
+def cache_from_env():
+    """
+    ResultCache configured by the RESULT_CACHE_DIR and RESULT_CACHE_GB environment variables
+    """
+    return open_cache(
+        os.getenv('RESULT_CACHE_DIR'),
+        float(os.getenv('RESULT_CACHE_GB', DEFAULT_CACHE_GB))
+    )
@@ -0,0 +1,33 @@
+import sys
+import polars as pl
+from agg_depr_space_time import parse_list, scan_days
+from od import daily_od_counts, roll_up_od, od_windows
+from table_io import read_table, write_table
+
+def main():
+
+    space_ks = parse_list(sys.argv[1])
+    time_ts = parse_list(sys.argv[2])
+
+    geoid_lu = read_table(sys.argv[3],
+                          dtypes={'GEOID': pl.Utf8,
+                                  "k": pl.Int32,
+                                  "cluster": pl.Utf8,
+                                  "k_cluster": pl.Utf8})
+
+    geoid_lu = geoid_lu.filter(pl.col('k').is_in(space_ks))
+
+    depr_fn = sys.argv[(3+1):(3+1+max(time_ts))]
+
+    # County OD counts by day, read from the trajectories once
+    od = daily_od_counts(scan_days(depr_fn)).collect(streaming=True)
+
+    # Every spatial resolution is rolled up from the county counts
+    cube = roll_up_od(od.lazy(), geoid_lu).collect()
+
+    write_table(cube.sort(['space', 'day', 'geoid_o', 'geoid_d']), sys.argv[-2])
+
+    write_table(od_windows(cube, time_ts).sort(['space', 't', 'geoid_o', 'geoid_d']), sys.argv[-1])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import math
+import numpy as np
+import polars as pl
+from distance_matrix import distance_pairs
+
+# Number of US counties, the 2019 US population and US land area (km^2)
+N_COUNTIES = 3_142
+US_POPULATION = 328_239_523
+US_LAND_AREA = 9_147_593
+
+# Distance of trips within a county (km): the radius of a county of mean area
+INTRA_COUNTY_DISTANCE = math.sqrt(US_LAND_AREA / N_COUNTIES / math.pi)
+
+def synthetic_counties(n_counties, seed=None) -> pl.DataFrame:
+    """
+    Synthetic counties (GEOID, lat, lng, POPESTIMATE2019)
+
+    Note:
+    Counties are split evenly over states (about 50 for N_COUNTIES counties) and scattered
+    around a random centre for each state. Populations are log-normal, scaled so that
+    N_COUNTIES counties have the US population
+    """
+    rng = np.random.default_rng(seed)
+
+    n_states = max(1, round(50 * n_counties / N_COUNTIES))
+    state = np.arange(n_counties) % n_states
+    county = np.arange(n_counties) // n_states + 1
+
+    state_lat = rng.uniform(28, 47, n_states)
+    state_lng = rng.uniform(-122, -70, n_states)
+
+    pop = rng.lognormal(10.3, 1.4, n_counties)
+    pop = pop * (US_POPULATION / N_COUNTIES) / pop.mean()
+
+    return pl.DataFrame({
+        'GEOID': [f"{s + 1:02d}{c:03d}" for s, c in zip(state, county)],
+        'lat': state_lat[state] + rng.normal(0, 1.5, n_counties),
+        'lng': state_lng[state] + rng.normal(0, 1.5, n_counties),
+        'POPESTIMATE2019': np.maximum(pop, 100).astype(np.int64)
+    })
+
+def synthetic_pij(counties, gamma=2.0, max_distance=None) -> pl.DataFrame:
+    """
+    Gravity model origin-destination weights (geoid_o, geoid_d, value) between synthetic counties,
+    proportional to destination population / (1 + distance) ^ gamma
+
+    max_distance: optional cutoff (km), pairs further apart are left out
+
+    Note:
+    Trips within a county are given INTRA_COUNTY_DISTANCE rather than zero, otherwise
+    nearly every exploration returns to the origin and DEPR rarely visits new locations
+    """
+    lat = counties['lat'].to_numpy()
+    lng = counties['lng'].to_numpy()
+    pop = counties['POPESTIMATE2019'].to_numpy()
+    geoid = counties['GEOID']
+
+    i, j, distance = distance_pairs(lat, lng, max_distance=max_distance)
+    distance = np.where(i == j, INTRA_COUNTY_DISTANCE, distance)
+
+    return pl.DataFrame({
+        'geoid_o': geoid[i],
+        'geoid_d': geoid[j],
+        'value': pop[j] / (1 + distance) ** gamma
+    })
+
+def synthetic_trajectories(counties, n_uids, trips_per_uid=5, duration=24, seed=None) -> pl.DataFrame:
+    """
+    Synthetic trajectories (uid, time, geoid) ordered by uid and time,
+    with a Poisson number of trips per uid at locations drawn by population
+    """
+    rng = np.random.default_rng(seed)
+
+    n_trips = 1 + rng.poisson(trips_per_uid - 1, n_uids)
+    uid = np.repeat(np.arange(n_uids, dtype=np.int32), n_trips)
+    time = (rng.random(len(uid)) * duration).astype(np.float32)
+    order = np.lexsort([time, uid])
+
+    pop = counties['POPESTIMATE2019'].to_numpy()
+    code = rng.choice(len(pop), size=len(uid), p=pop / pop.sum())
+
+    return pl.DataFrame({
+        'uid': uid[order],
+        'time': time[order],
+        'geoid': counties['GEOID'][code]
+    })
@@ -0,0 +1,98 @@
+import os
+import polars as pl
+
+# Columns holding geoids, stored as categoricals in columnar formats
+GEOID_COLUMNS = ['GEOID', 'GEOID_origin', 'GEOID_dest', 'geoid', 'geoid_o', 'geoid_d', 'k_cluster']
+
+def table_format(fn):
+    """
+    Table format from the file extension: parquet, ipc (.arrow, .ipc, .feather) or csv
+    """
+    ext = os.path.splitext(str(fn))[1].lower()
+    if ext == '.parquet':
+        return 'parquet'
+    if ext in ['.arrow', '.ipc', '.feather']:
+        return 'ipc'
+    return 'csv'
+
+def compact_types(df):
+    """
+    Store geoids as categoricals and uids as int32, in a DataFrame or LazyFrame
+    """
+    casts = [pl.col(col).cast(pl.Categorical) for col in GEOID_COLUMNS if df.schema.get(col) == pl.Utf8]
+    if df.schema.get('uid') in pl.INTEGER_DTYPES:
+        casts.append(pl.col('uid').cast(pl.Int32))
+    return df.with_columns(casts)
+
+def _restore_types(frame, dtypes=None):
+    """
+    Read categorical geoids back as strings, so that tables read from
+    different files can be joined without a global string cache, 
+    and cast any columns given in dtypes, as read_csv would
+    """
+    frame = frame.with_columns(pl.col(pl.Categorical).cast(pl.Utf8))
+    if dtypes:
+        frame = frame.with_columns([
+            pl.col(col).cast(dtype) for col, dtype in dtypes.items() if col in frame.columns
+        ])
+    return frame
+
+def read_table(fn, columns=None, dtypes=None) -> pl.DataFrame:
+    """
+    Read a table in any supported format
+
+    Note:
+    Columnar formats store their types and are memory mapped, 
+    dtypes are applied to them as casts
+    """
+    fmt = table_format(fn)
+    if fmt == 'parquet':
+        return _restore_types(pl.read_parquet(fn, columns=columns, memory_map=True), dtypes)
+    if fmt == 'ipc':
+        return _restore_types(pl.read_ipc(fn, columns=columns, memory_map=True), dtypes)
+    return pl.read_csv(fn, columns=columns, dtypes=dtypes)
+
+def scan_table(fn, dtypes=None) -> pl.LazyFrame:
+    """
+    Lazily scan a table (or glob of tables) in any supported format
+    """
+    fmt = table_format(fn)
+    if fmt == 'parquet':
+        return _restore_types(pl.scan_parquet(fn), dtypes)
+    if fmt == 'ipc':
+        return _restore_types(pl.scan_ipc(fn, memory_map=True), dtypes)
+    return pl.scan_csv(fn, dtypes=dtypes)
+
+def write_table(df: pl.DataFrame, fn):
+    """
+    Write a table in the format given by its extension, with compact types for columnar formats
+
+    Note:
+    Parquet is zstd compressed for size on disk. 
+    Arrow IPC is left uncompressed so that it can be memory mapped when read
+    """
+    fmt = table_format(fn)
+    if fmt == 'parquet':
+        compact_types(df).write_parquet(fn, compression='zstd')
+    elif fmt == 'ipc':
+        compact_types(df).write_ipc(fn, compression='uncompressed')
+    else:
+        df.write_csv(fn)
+
+def sink_table(lf: pl.LazyFrame, fn):
+    """
+    Stream a LazyFrame to a table in the format given by its extension, 
+    without collecting it in memory
+
+    Note:
+    Formats and compression are as in write_table. 
+    CSV is collected (with the streaming engine) and written instead, 
+    as sink_csv can deadlock on joined frames in polars 0.19
+    """
+    fmt = table_format(fn)
+    if fmt == 'parquet':
+        compact_types(lf).sink_parquet(fn, compression='zstd')
+    elif fmt == 'ipc':
+        compact_types(lf).sink_ipc(fn, compression=None)
+    else:
+        write_table(lf.collect(streaming=True), fn)
@@ -0,0 +1,44 @@
+import subprocess
+import sys
+from pathlib import Path
+import polars as pl
+
+SRC = Path(__file__).resolve().parents[1] / 'src'
+sys.path.insert(0, str(SRC))
+
+from synthetic import synthetic_counties, synthetic_trajectories
+
+def run_script(script, *args):
+    # A timeout, so a hanging sink fails the test rather than stalling it
+    subprocess.run([sys.executable, str(SRC / script), *map(str, args)], check=True, timeout=120)
+
+def test_errors_csv(tmp_path):
+    """
+    calc_privacy_error writes --errors and --metrics as CSV, as in the all_privacy_sensitivity rule
+    """
+    counties = synthetic_counties(30, seed=1)
+    synthetic_trajectories(counties, 2_000, seed=1).write_parquet(tmp_path / 'depr.parquet')
+
+    run_script('base_analytics.py', tmp_path / 'depr.parquet', tmp_path / 'base.csv')
+    run_script('apply_privacy.py',
+               '--infn', tmp_path / 'depr.parquet',
+               '--construction', 'GDP',
+               '--epsilon', '1,2',
+               '--sensitivity', '5',
+               '--seed', '1',
+               '--trials', '2',
+               '--outfn', tmp_path / 'gdp.parquet')
+    run_script('calc_privacy_error.py',
+               tmp_path / 'base.csv',
+               tmp_path / 'gdp.parquet',
+               '--errors', tmp_path / 'x.csv',
+               '--metrics', tmp_path / 'metrics.csv')
+
+    errors = pl.read_csv(tmp_path / 'x.csv')
+    assert errors.height > 0
+    assert {'squared_error', 'absolute_percentage_error'} <= set(errors.columns)
+    assert errors['trial'].unique().to_list() == [0]
+
+    metrics = pl.read_csv(tmp_path / 'metrics.csv')
+    assert metrics.height == 2
+    assert metrics['n_trials'].to_list() == [2, 2]